@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# Benchmarks the phases of matching on synthetic corpora, generated by
+# replicating and mutating the bundled products and listings, and reports the
+# timings as JSON so that they can be compared between commits.
+
+from match import read_products_data, read_listings_data, prepare_manufacturers, \
+    resolve_listings_batch, match_listings_batch, iter_batches, write_results, map_file, \
+    DEFAULT_ENGINE, UNKNOWN_MANUFACTURER, UNKNOWN_MODEL, \
+    DEFAULT_PRODUCTS_FILE, DEFAULT_LISTINGS_FILE
+from collections import OrderedDict
+from itertools import izip
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+PHASES = ['load', 'prepare_regexes', 'resolve_manufacturers', 'match_products', 'write_results']
+
+# Words added to the titles of mutated listings
+_extra_title_words = [u'New', u'Brand New', u'Black', u'Silver', u'Kit', u'Bundle', u'Refurbished']
+
+
+def scales_list(string):
+    '''Parses a comma-separated list of positive integer scale factors.'''
+    try:
+        scales = [int(s) for s in string.split(',') if s.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid list of scales: {0!r}'.format(string))
+    if not scales or min(scales) < 1:
+        raise argparse.ArgumentTypeError('invalid list of scales: {0!r}'.format(string))
+    return scales
+
+
+def parse_my_arguments(arguments=None):
+    '''Processes the arguments to the command using argparse and returns the
+    resulting object.'''
+
+    parser = argparse.ArgumentParser(
+        description='''Benchmarks matching on synthetic corpora generated from
+                       the products and listings files, timing each phase
+                       (loading, preparing the regexes, resolving
+                       manufacturers, matching products and writing the
+                       results) and reporting the timings, throughput and peak
+                       memory use as JSON.'''
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        help='report progress'
+    )
+    parser.add_argument(
+        '-p', '--products',
+        metavar='PRODUCTS_FILE',
+        default=DEFAULT_PRODUCTS_FILE,
+        help='file containing JSON objects (one per line) describing the products'
+    )
+    parser.add_argument(
+        '-l', '--listings',
+        metavar='LISTINGS_FILE',
+        default=DEFAULT_LISTINGS_FILE,
+        help='file containing JSON objects (one per line) describing the listings'
+    )
+    parser.add_argument(
+        '--listing-scales',
+        type=scales_list, default=[1, 10], metavar='N[,N...]',
+        help='''numbers of copies of the listings to benchmark with (default is
+                1,10)'''
+    )
+    parser.add_argument(
+        '--catalog-scales',
+        type=scales_list, default=[1, 10], metavar='N[,N...]',
+        help='''numbers of variants of each product to benchmark with (default
+                is 1,10)'''
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int, default=1, metavar='N',
+        help='''run each benchmark N times, and report the fastest time for
+                each phase'''
+    )
+    parser.add_argument(
+        '--seed',
+        type=int, default=0,
+        help='seed for generating the synthetic corpora'
+    )
+    parser.add_argument(
+        '--data-dir',
+        metavar='DIR',
+        help='''write the synthetic corpora to this directory, and keep them
+                (by default they are written to a temporary directory, which is
+                removed afterwards)'''
+    )
+    parser.add_argument(
+        '-o', '--output',
+        type=argparse.FileType('w'), default='-', metavar='OUTPUT_FILE',
+        help='file to write the JSON report to (default is stdout)'
+    )
+    parser.add_argument(
+        '--compare',
+        type=argparse.FileType('r'), metavar='PREVIOUS_REPORT',
+        help='''a report from a previous run, to compare against; the change in
+                each timing is written to stderr'''
+    )
+
+    if arguments is not None:
+        if isinstance(arguments, list):
+            args = parser.parse_args(arguments)
+        elif isinstance(arguments, str):
+            args = parser.parse_args(arguments.split())
+        else:
+            raise TypeError("'arguments' must be either a string or a list of strings")
+    else:
+        args = parser.parse_args()
+
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+
+    return args
+
+
+def mutate_listing(jsondata, rng):
+    '''Returns a copy of the decoded listing `jsondata`, with its title and
+    price changed in ways that are typical of real listings.'''
+    jsondata = dict(jsondata)
+    title = jsondata['title']
+    mutation = rng.randrange(5)
+    if mutation == 0:
+        title = rng.choice(_extra_title_words) + u' ' + title
+    elif mutation == 1:
+        title = title + u' - ' + rng.choice(_extra_title_words)
+    elif mutation == 2:
+        words = title.split(u' ', 1)
+        title = u' '.join([words[0], rng.choice(_extra_title_words)] + words[1:])
+    elif mutation == 3:
+        title = title.replace(u' ', u'  ', 1)
+    jsondata['title'] = title
+    try:
+        price = float(jsondata['price']) * rng.uniform(0.9, 1.1)
+        jsondata['price'] = '{0:.2f}'.format(price)
+    except (KeyError, ValueError):
+        pass
+    return jsondata
+
+
+def product_variant(jsondata, n):
+    '''Returns the `n`th variant (n > 0) of the decoded product `jsondata`:
+    a product of the same manufacturer and family, with a distinct name and
+    model.'''
+    suffix = ''
+    while n:
+        n, r = divmod(n - 1, 26)
+        suffix = chr(ord('a') + r) + suffix
+    jsondata = dict(jsondata)
+    jsondata['product_name'] = jsondata['product_name'] + u'_' + suffix
+    jsondata['model'] = jsondata['model'] + suffix
+    return jsondata
+
+
+def _dumps(jsondata):
+    return json.dumps(jsondata, separators=(',', ':'), ensure_ascii=False).encode('utf8') + '\n'
+
+
+def generate_listings(listings_filename, output_filename, scale, seed):
+    '''Writes `scale` copies of the listings to the output file: the first
+    unchanged, the rest mutated. Returns the number of listings written.'''
+    rng = random.Random(seed)
+    count = 0
+    with open(listings_filename, 'rb') as listings_file:
+        listings_data = listings_file.readlines()
+    with open(output_filename, 'wb') as output:
+        for n in xrange(scale):
+            for lj in listings_data:
+                if n:
+                    lj = _dumps(mutate_listing(json.loads(lj), rng))
+                output.write(lj)
+                count += 1
+    return count
+
+
+def generate_products(products_filename, output_filename, scale):
+    '''Writes each product to the output file along with `scale` - 1
+    variants of it. Returns the number of products written.'''
+    count = 0
+    with open(products_filename, 'rb') as products_file:
+        products_data = products_file.readlines()
+    with open(output_filename, 'wb') as output:
+        for pj in products_data:
+            output.write(pj)
+            count += 1
+            if scale > 1:
+                jsondata = json.loads(pj)
+                for n in xrange(1, scale):
+                    output.write(_dumps(product_variant(jsondata, n)))
+                    count += 1
+    return count
+
+
+def run_case(case):
+    '''Runs the matching, as match.py does with its default options, for the
+    given products and listings files, timing each phase. The listings are
+    matched in batches with the default engine (see `match_listings_batches`),
+    in two phases for each batch: resolving the manufacturers of the distinct
+    listings, and matching them to products. Returns a dict of the timings, counts and peak
+    memory use. This is run in a fresh process for each benchmark, so that
+    the peak memory use is its own.'''
+    products_filename, listings_filename = case
+    timings = OrderedDict()
+
+    start = time.time()
+    with open(products_filename, 'rb') as products_file:
+        products_data = products_file.readlines()
+    products, manufacturers = read_products_data(products_data)
+    listings_file = open(listings_filename, 'rb')
+    listings = read_listings_data(listings_file)
+    timings['load'] = time.time() - start
+
+    start = time.time()
+    index = prepare_manufacturers(manufacturers)
+    timings['prepare_regexes'] = time.time() - start
+
+    timings['resolve_manufacturers'] = 0.0
+    timings['match_products'] = 0.0
+    matched = 0
+    for batch in iter_batches(listings):
+        start = time.time()
+        resolved = resolve_listings_batch(batch, manufacturers, index)
+        timings['resolve_manufacturers'] += time.time() - start
+
+        start = time.time()
+        outcomes = match_listings_batch(batch, manufacturers, index, DEFAULT_ENGINE, resolved)
+        for L, outcome in izip(batch, outcomes):
+            if outcome is not UNKNOWN_MANUFACTURER and outcome is not UNKNOWN_MODEL:
+                outcome.associate_listing(L)
+                matched += 1
+        timings['match_products'] += time.time() - start
+
+    start = time.time()
+    source = map_file(listings_file)
+    results_file = tempfile.TemporaryFile()
+    write_results(results_file, products, False, source)
+    results_file.close()
+    source.close()
+    listings_file.close()
+    timings['write_results'] = time.time() - start
+
+    return {
+        'products': len(products),
+        'listings': len(listings),
+        'matched': matched,
+        'timings': timings,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_benchmark(products_filename, listings_filename, repeat):
+    '''Runs `run_case` `repeat` times, each in its own process, and returns
+    the combined result, with the fastest time for each phase.'''
+    result = None
+    for _ in xrange(repeat):
+        pool = multiprocessing.Pool(1)
+        try:
+            run = pool.apply(run_case, [(products_filename, listings_filename)])
+            pool.close()
+        finally:
+            pool.join()
+        if result is None:
+            result = run
+        else:
+            for phase in PHASES:
+                result['timings'][phase] = min(result['timings'][phase], run['timings'][phase])
+            result['peak_rss_kb'] = max(result['peak_rss_kb'], run['peak_rss_kb'])
+
+    timings = result['timings']
+    result['total'] = sum(timings.itervalues())
+    matching_time = timings['resolve_manufacturers'] + timings['match_products']
+    result['listings_per_second'] = result['listings'] / matching_time if matching_time else None
+    return result
+
+
+def git_revision():
+    '''Returns the current git commit of the code being benchmarked, or None
+    if it isn't known.'''
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_name(catalog_scale, listing_scale):
+    return 'products-x{0}-listings-x{1}'.format(catalog_scale, listing_scale)
+
+
+def compare_reports(previous, report):
+    '''Writes the change in each timing (and in the peak memory use) between
+    the previous report and the new one to stderr.'''
+    previous_cases = dict((case['name'], case) for case in previous['cases'])
+    for case in report['cases']:
+        old = previous_cases.get(case['name'])
+        if old is None:
+            continue
+        sys.stderr.write('{0}:\n'.format(case['name']))
+        for phase in PHASES + ['total']:
+            if phase != 'total' and phase not in old['timings']:
+                # (the previous report was made with different phases)
+                continue
+            old_time = old['timings'][phase] if phase != 'total' else old['total']
+            new_time = case['timings'][phase] if phase != 'total' else case['total']
+            sys.stderr.write('  {0:22} {1:8.3f}s -> {2:8.3f}s  ({3:+.1f}%)\n'.format(
+                phase, old_time, new_time,
+                100.0 * (new_time - old_time) / old_time if old_time else 0.0))
+        sys.stderr.write('  {0:22} {1:8}kB -> {2:8}kB\n'.format(
+            'peak_rss_kb', old['peak_rss_kb'], case['peak_rss_kb']))
+
+
+def main(arguments=None):
+    args = parse_my_arguments(arguments)
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='bench-')
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    report = OrderedDict([
+        ('revision', git_revision()),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('cases', []),
+    ])
+
+    try:
+        products_files = {}
+        for catalog_scale in args.catalog_scales:
+            filename = os.path.join(data_dir, 'products-x{0}.txt'.format(catalog_scale))
+            generate_products(args.products, filename, catalog_scale)
+            products_files[catalog_scale] = filename
+
+        for listing_scale in args.listing_scales:
+            listings_filename = os.path.join(data_dir, 'listings-x{0}.txt'.format(listing_scale))
+            generate_listings(args.listings, listings_filename, listing_scale, args.seed)
+
+            for catalog_scale in args.catalog_scales:
+                name = case_name(catalog_scale, listing_scale)
+                if args.verbose:
+                    sys.stderr.write('Running {0}...\n'.format(name))
+                result = run_benchmark(products_files[catalog_scale], listings_filename, args.repeat)
+                case = OrderedDict([
+                    ('name', name),
+                    ('catalog_scale', catalog_scale),
+                    ('listing_scale', listing_scale),
+                ])
+                case.update(sorted(result.iteritems()))
+                report['cases'].append(case)
+                if args.verbose:
+                    sys.stderr.write('  {0:.3f}s total, {1:.0f} listings/s\n'.format(
+                        case['total'], case['listings_per_second'] or 0))
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    json.dump(report, args.output, indent=2)
+    args.output.write('\n')
+    args.output.close()
+
+    if args.compare:
+        compare_reports(json.load(args.compare), report)
+        args.compare.close()
+
+
+
+if __name__=='__main__':
+    try:
+        main()
+        sys.exit(0)
+    except KeyboardInterrupt as e:
+        raise e
+    except SystemExit as e:
+        raise e
+    except argparse.ArgumentError as e:
+        print str(e)
+    except Exception as e:
+        print str(e)
+        traceback.print_exc()
+        sys.exit(1)
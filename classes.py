@@ -1,91 +1,560 @@
 # -*- coding: utf8 -*-
 
 import re
+import heapq
 import json
+from json.decoder import scanstring
+import mmap
+import sre_parse
 import sys
+import time
+from array import array
+from bisect import bisect_right
+from itertools import izip
+from sre_constants import LITERAL
 
 
+# Version of the rules used to prepare products for matching. This must be
+# incremented whenever a change is made that affects the prepared matchers,
+# so that previously cached preparations are not reused.
+MATCHING_RULES_VERSION = 4
+
+# The number of distinct listing manufacturer strings, and of title starts,
+# for which a `CatalogIndex` remembers the manufacturers found
+RESOLUTION_CACHE_SIZE = 4096
+
+# The number of distinct listings (by manufacturer and searchable title) for
+# which a `CatalogIndex` remembers the outcome of matching
+MATCH_CACHE_SIZE = 65536
+
+# The most time, in seconds, that a model regex may take to search any one of
+# the titles chosen to be slow for it, before `Manufacturer.analyze_regexes`
+# reports it
+REGEX_COST_LIMIT = 50e-6
+
+# Marks a missing value, where None is a valid one
+_missing = object()
+
 # Note: '[^\W\d_]' is apparently the recommended character class
 # for 'any unicode letter, but not digits' in python
 _re_word_like = re.compile(r'^[^\W\d_]{3,}$', flags=re.U)
 
 _re_short_number = re.compile(r'^\s*\d{1,3}\s*$', flags=re.U)
+# The same, for matching a span of a string in place (with `pos` and
+# `endpos`, as '^' only matches at the real start of the string)
+_re_short_number_span = re.compile(r'\s*\d{1,3}\s*$', flags=re.U)
+
+# Words after which the rest of a listing title is ignored
+_break_words = [u'for', u'pour', u'für']
+
+# Only this many characters at the start of a listing title are searched
+SEARCHABLE_TITLE_LENGTH = 50
+
+# Parts of a listing title that are ignored: something in parentheses (group
+# 1), or one of the break words
+_re_title_ignored = re.compile(
+    r'(\(.*?\))|\b(?:' + '|'.join(_break_words) + r')\b', flags=re.U)
+
+# The start of the value of a listing's title or manufacturer field (named by
+# group 1), within its JSON object string
+_re_listing_field = re.compile(r'[{,]\s*"(title|manufacturer)"\s*:\s*"')
+
+# A run of letters, or a run of digits
+_re_alnum_run = re.compile(r'[^\W\d_]+|\d+', flags=re.U)
+
+# Two or more adjacent '\W*'s in a model regex, which match no more than one
+# would, but can split a run of punctuation between them in every possible way
+# before failing
+_re_repeated_nonword = re.compile(r'(?:\\W\*){2,}')
+
+# The parts of a model regex that aren't literal text: escape sequences
+# (which leaves out escaped punctuation, and the rare escaped letter) and
+# counted repeats
+_re_regex_syntax = re.compile(r'\\.|\{\d*,?\d*\}', flags=re.U)
+
+# Separators repeated to the end of the titles that model regexes are timed
+# against (see `_stress_titles`)
+_stress_fillers = [u' ', u' -', u'/.']
+
+
+def read_span(source, offset, length):
+    '''Returns the `length` bytes at `offset` within `source`, a seekable
+    file or an mmap. For an mmap this is a buffer onto the mapped bytes, rather
+    than a copy of them.'''
+    if isinstance(source, mmap.mmap):
+        return buffer(source, offset, length)
+    source.seek(offset)
+    return source.read(length)
+
+
+def _required_literals(pattern, flags=0):
+    '''Returns a list of the runs of letters (or of digits) that must all be
+    present verbatim in any string matched by the regular expression
+    `pattern`, in the order they appear in it.'''
+    # Only the top level of the parsed expression is examined: consecutive
+    # literal characters there must appear consecutively in any match, while
+    # anything nested (optional groups, repeats, lookaheads) may not.
+    runs = []
+    run = []
+    for op, av in sre_parse.parse(pattern, flags):
+        if op == LITERAL:
+            run.append(unichr(av))
+        elif run:
+            runs.append(u''.join(run))
+            run = []
+    if run:
+        runs.append(u''.join(run))
+
+    literals = []
+    for run in runs:
+        for segment in _re_alnum_run.findall(run):
+            if segment not in literals:
+                literals.append(segment)
+    return literals
+
+
+def _pattern_literals(pattern):
+    '''Returns a list of the runs of letters (or of digits) written in the
+    model regex `pattern`, whether they are required or optional, in the order
+    they appear in it.'''
+    return _re_alnum_run.findall(_re_regex_syntax.sub(u' ', pattern))
+
+
+def _stress_titles(pattern):
+    '''Returns a list of searchable titles that are likely to be slow for
+    the model regex `pattern` to search: each starts with more of the
+    pattern's literals than the last, and is padded out with separators,
+    which the '\W*'s in the pattern may try to match in many ways before the
+    search fails.'''
+    literals = _pattern_literals(pattern)
+    titles = []
+    for n in range(1, len(literals) + 1):
+        start = u' '.join(literals[:n])
+        for filler in _stress_fillers:
+            titles.append((start + filler * SEARCHABLE_TITLE_LENGTH)[:SEARCHABLE_TITLE_LENGTH])
+    return titles
+
+
+def _simplified_pattern(pattern):
+    '''Returns a model regex equivalent to `pattern` (matching the same
+    spans of any string), but with adjacent '\W*'s merged, so that it
+    backtracks less.'''
+    return _re_repeated_nonword.sub(r'\\W*', pattern)
 
-_break_words = []
-for w in [u'for', u'pour', u'für']:
-    _break_words.append(re.compile(r'\b' + w + r'\b', flags=re.U))
+
+def _longest_alnum_run(string):
+    '''Returns the longest run of letters (or of digits) in `string`, or None
+    if there are none.'''
+    runs = _re_alnum_run.findall(string)
+    if not runs:
+        return None
+    return max(runs, key=len)
+
+
+def _trie_regex_string(keys):
+    '''Returns a regular expression string matching any of the strings in
+    `keys`, structured as a trie so that the cost of a match attempt does not
+    grow with the number of keys. Where several keys match at the same
+    position, the longest is matched.'''
+    trie = {}
+    for key in keys:
+        node = trie
+        for c in key:
+            node = node.setdefault(c, {})
+        # Mark the end of a key
+        node[''] = True
+    return _trie_node_regex_string(trie)
+
+
+def _trie_node_regex_string(node):
+    branches = [re.escape(c) + _trie_node_regex_string(child)
+                for (c, child) in sorted(node.iteritems()) if c]
+    if not branches:
+        return ''
+    if len(branches) == 1:
+        regex = branches[0]
+    else:
+        regex = '(?:' + '|'.join(branches) + ')'
+    if '' in node:
+        # A key ends here; anything more is optional (but greedy, so that the
+        # longest key is preferred)
+        regex = '(?:' + regex + ')?'
+    return regex
 
 
 class ProductMatch(object):
     '''Simple class used to represent a match between a product and a
     listing.'''
+    __slots__ = ('product', 'listing', 'begin', 'length')
+
     def __init__(self, product, listing, begin, length):
         self.product = product
         self.listing = listing
         self.begin = begin
         self.length = length
 
-    def sanity_check(self):
-        '''Runs a sanity check on a match, to make sure it's not matching
-        something too insubstantial. Returns the match if it's deemed valid,
-        and None if it isn't.'''
+    @property
+    def matched_text(self):
+        '''The span of the listing's searchable title covered by the match.
+        (For a match of the model's tokens, this runs from the first token
+        matched, for the total length of the tokens.)'''
+        return self.listing.searchable_title[self.begin:self.begin+self.length]
 
-        out_match = self
-        # If all we matched was a number, don't count it as a match ... unless
-        # that's really all we have to go on.
-        if _re_short_number.match(self.listing.searchable_title[self.begin:self.begin+self.length])\
-                and not (_re_short_number.match(self.product.model) and not self.product.family):
-            out_match = None
-        # A single character should never be enough to constitute a match.
-        elif self.length < 2:
-            out_match = None
 
-        return out_match
+class Deadline(object):
+    '''A time limit for matching a listing, `seconds` from now (see
+    `Manufacturer.find_matching_products`). At least one product is always
+    tried, however long that takes; .skipped records whether any products
+    were then left untried because the time was up.'''
+    __slots__ = ('time', 'started', 'skipped')
+
+    def __init__(self, seconds):
+        self.time = time.time() + seconds
+        self.started = False
+        self.skipped = False
+
+    def passed(self):
+        '''Called before trying each product: returns True if the time is up
+        (and a product has already been tried), in which case the product
+        is skipped, along with any others still to be tried.'''
+        if not self.started:
+            self.started = True
+            return False
+        if time.time() > self.time:
+            self.skipped = True
+            return True
+        return False
+
+
+class MatchRanking(object):
+    '''Keeps the best `k` of the `ProductMatch`es added to it. The best match
+    is the one that starts earliest in the listing, then the one with the
+    longest matching amount of text, then the one added first.'''
+    def __init__(self, k):
+        self.k = k
+        # A heap of (-begin, length, -count, match), so that the worst match
+        # kept is at the top
+        self._heap = []
+        self._count = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    @property
+    def bound(self):
+        '''The (begin, -length) that a match must sort before to be kept,
+        or None if any match would be.'''
+        if len(self._heap) < self.k:
+            return None
+        worst = self._heap[0]
+        return (-worst[0], -worst[1])
+
+    def add(self, match):
+        '''Adds a match, if it is among the best `k` so far.'''
+        self._count += 1
+        item = (-match.begin, match.length, -self._count, match)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+        elif item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+
+    def matches(self):
+        '''Returns a list of the matches kept, best first.'''
+        return [item[3] for item in sorted(self._heap, reverse=True)]
 
 
 class Matcher(object):
-    '''Stores a compiled regular expression and a flag to indicate whether the
-    listing is required to match that re.'''
+    '''Stores a regular expression (compiled on first use) and a flag to
+    indicate whether the listing is required to match that re.'''
+    __slots__ = ('pattern', 'required', 'keys', '_re')
+
     def __init__(self, regex, required=True):
-        self.re = re.compile(regex, re.U)
+        self.pattern = regex
         self.required = required
+        self._re = None
+        # The runs of letters or digits that must all be present in the
+        # listing for the regex to match
+        self.keys = _required_literals(regex, re.U)
 
+    @property
+    def re(self):
+        if self._re is None:
+            self._re = re.compile(self.pattern, re.U)
+        return self._re
 
-class Listing(object):
-    def __init__(self, jsonstring):
-        self.orig_data = jsonstring
-        jsondata = json.loads(jsonstring)
-        self.title = jsondata['title'].lower()
-        self.manufacturer = jsondata['manufacturer'].lower()
-        self.price = jsondata['price']
-        self.currency = jsondata['currency']
-        self.make_searchable_title()
+    def search(self, string, memo=None):
+        '''Returns the (begin, end) span of the first match of the regex in
+        `string`, or None if there is none. If `memo` (a dict) is given, the
+        result is looked up in it by pattern, or stored there, so that
+        matchers with the same pattern search the same string only once.'''
+        if memo is not None:
+            span = memo.get(self.pattern, _missing)
+            if span is not _missing:
+                return span
+        m = self.re.search(string)
+        span = m.span() if m else None
+        if memo is not None:
+            memo[self.pattern] = span
+        return span
+
+    def search_cost(self, titles, repeat=3):
+        '''Returns the most time, in seconds, that the regex takes to search
+        any one of `titles`. A title that seems to be the slowest so far is
+        searched again (up to `repeat` times in all), and the quickest time
+        taken, so that a one-off delay isn't counted against the regex.'''
+        search = self.re.search
+        worst = 0.0
+        for title in titles:
+            cost = None
+            for i in range(repeat):
+                start = time.time()
+                search(title)
+                elapsed = time.time() - start
+                if cost is None or elapsed < cost:
+                    cost = elapsed
+                if cost <= worst:
+                    break
+            worst = max(worst, cost)
+        return worst
 
-    def make_searchable_title(self):
-        '''Create a copy of the title string, mangled such that it is suitable
-        for searching against for model and manufacturer info. Stores the
-        result in the .searchable_title attribute.'''
+    def to_data(self):
+        '''Returns the matcher as a list suitable for JSON serialisation.'''
+        return [self.pattern, self.required, self.keys]
 
-        self.searchable_title = self.title
-        # Ignore things in parentheses: replace contents with spaces (to
-        # preserve the distance for the 50-char truncation to follow)
-        self.searchable_title = re.sub(
-            r'\(.*?\)',
-            lambda m: ' '*len(m.group()),
-            self.searchable_title, flags=re.U)
-        # Ignore anything following words like 'for'
-        for w in _break_words:
-            m = w.search(self.searchable_title)
-            if m:
-                self.searchable_title = self.searchable_title[:m.start()]
+    @classmethod
+    def from_data(cls, data):
+        '''Recreates a matcher from the output of `to_data`, without
+        re-analysing its regex.'''
+        matcher = cls.__new__(cls)
+        matcher.pattern, matcher.required, matcher.keys = data
+        matcher._re = None
+        return matcher
+
+
+class KeywordIndex(object):
+    '''Maps keywords to sets of values, and finds the values for all of the
+    keywords present (as substrings) in a string with a single regex pass over
+    it. Keywords are added with `add`; `compile` must then be called before
+    searching with `find`.'''
+    def __init__(self):
+        self._key_values = {}
+        self._always = set()
+        self._pattern = None
+        self._re = None
+
+    def add(self, key, value):
+        '''Associates `value` with the keyword `key`. If `key` is None, the
+        value is always found.'''
+        if key is None:
+            self._always.add(value)
+        else:
+            self._key_values.setdefault(key, set()).add(value)
+
+    def compile(self):
+        # The regex only reports the longest keyword found at each position,
+        # so each keyword must also stand in for any keywords that are
+        # prefixes of it.
+        self._closure = {}
+        for key in self._key_values:
+            values = set()
+            for n in range(1, len(key) + 1):
+                values.update(self._key_values.get(key[:n], ()))
+            self._closure[key] = values
 
+        if self._key_values:
+            # A lookahead, so that matches at every position are found (even
+            # where they overlap). It is compiled on first use.
+            self._pattern = '(?=(' + _trie_regex_string(self._key_values) + '))'
+        else:
+            self._pattern = None
+        self._re = None
+
+    def find(self, string):
+        '''Returns a set of the values of all keywords present in `string`,
+        along with any values that are always found.'''
+        found = set(self._always)
+        if self._pattern:
+            if self._re is None:
+                self._re = re.compile(self._pattern, re.U)
+            for key in set(self._re.findall(string)):
+                found.update(self._closure[key])
+        return found
+
+
+def searchable_title(title):
+    '''Returns a copy of the (lower-cased) listing title string, mangled
+    such that it is suitable for searching against for model and manufacturer
+    info (see `Listing.make_searchable_title`).'''
+    # This is done in a single pass over the title, which stops as soon as
+    # the rest of the title can't affect the result
+    m = _re_title_ignored.search(title)
+    if m is None or m.start() >= SEARCHABLE_TITLE_LENGTH:
+        # (the usual case)
+        return title[:SEARCHABLE_TITLE_LENGTH]
+
+    pieces = []
+    pos = 0
+    for m in _re_title_ignored.finditer(title, m.start()):
+        start = m.start()
         # Only look at the first 50 characters; if the model number shows up
         # after that it's probably an accessory to the model, not the actual
-        # product)
-        self.searchable_title = self.searchable_title[:50]
+        # product
+        if start >= SEARCHABLE_TITLE_LENGTH:
+            break
+        pieces.append(title[pos:start])
+        if m.group(1) is None:
+            # Ignore anything following words like 'for'
+            return ''.join(pieces)[:SEARCHABLE_TITLE_LENGTH]
+        # Ignore things in parentheses: replace contents with spaces (to
+        # preserve the distance for the truncation)
+        pos = m.end()
+        pieces.append(' ' * (pos - start))
+    pieces.append(title[pos:SEARCHABLE_TITLE_LENGTH])
+    return ''.join(pieces)[:SEARCHABLE_TITLE_LENGTH]
+
+
+def searchable_titles(titles):
+    '''Returns a list of the searchable titles (see `searchable_title`) for
+    a list of (lower-cased) listing titles.'''
+    return map(searchable_title, titles)
+
+
+def _extract_listing_fields(data):
+    '''Returns the (title, manufacturer) of the listing JSON object string
+    `data`, decoded without decoding the rest of the object, or None if the
+    object isn't simple enough for this to be done reliably (if it has nested
+    objects or repeated fields, or either field isn't a string).'''
+    if data[:1] != '{' or data[-1:] != '}' or data.count('{') != 1 or \
+            data.count('"title"') != 1 or data.count('"manufacturer"') != 1:
+        return None
+    fields = {}
+    pos = 0
+    while len(fields) < 2:
+        # (searching on from the end of the previous value, so that nothing
+        # within a string is mistaken for a field)
+        m = _re_listing_field.search(data, pos)
+        if m is None:
+            return None
+        fields[m.group(1)], pos = scanstring(data, m.end())
+    return fields['title'], fields['manufacturer']
+
+
+class Listing(object):
+    '''A listing, holding only what is needed to match it. The original JSON
+    string is kept in .orig_data, unless `keep_data` is False, in which case
+    the listing can only be read back using its byte .offset and .length
+    within its source file (which locate the JSON object itself, without any
+    surrounding whitespace). Only the title and manufacturer are decoded up
+    front (see `_extract_listing_fields`); the other fields of the JSON object
+    are decoded from .orig_data on demand.'''
+    __slots__ = ('orig_data', 'offset', 'length', 'manufacturer', 'searchable_title')
+
+    def __init__(self, jsonstring, offset=None, keep_data=True):
+        data = jsonstring.strip()
+        fields = _extract_listing_fields(data)
+        if fields is None:
+            jsondata = json.loads(data)
+            fields = (jsondata['title'], jsondata['manufacturer'])
+        title, manufacturer = fields
+
+        self.orig_data = jsonstring if keep_data else None
+        # Location of the listing within its source file, if known
+        self.offset = offset + jsonstring.find(data) if offset is not None else None
+        self.length = len(data)
+        self.manufacturer = manufacturer.lower()
+        self.make_searchable_title(title.lower())
+
+    @classmethod
+    def from_fields(cls, offset, length, manufacturer, searchable_title):
+        '''Recreates a listing (without its data) from stored fields, such
+        as those held by a `ListingTable`.'''
+        listing = cls.__new__(cls)
+        listing.orig_data = None
+        listing.offset = offset
+        listing.length = length
+        listing.manufacturer = manufacturer
+        listing.searchable_title = searchable_title
+        return listing
+
+    def _decoded_field(self, name):
+        if self.orig_data is None:
+            raise AttributeError('the data for this listing was not kept')
+        return json.loads(self.orig_data)[name]
+
+    @property
+    def title(self):
+        return self._decoded_field('title').lower()
+
+    @property
+    def price(self):
+        return self._decoded_field('price')
+
+    @property
+    def currency(self):
+        return self._decoded_field('currency')
+
+    def make_searchable_title(self, title):
+        '''Create a copy of the (lower-cased) title string, mangled such that
+        it is suitable for searching against for model and manufacturer info.
+        Stores the result in the .searchable_title attribute.'''
+        self.searchable_title = searchable_title(title)
+
+
+class ListingTable(object):
+    '''Compact, column-wise storage for a large number of listings, keeping
+    only what is needed to match them and to read them back from their source
+    file. Indexing or iterating over the table gives `Listing` objects (without
+    their data), created on demand.'''
+    def __init__(self):
+        self.offsets = array('L')
+        self.lengths = array('I')
+        # Manufacturer strings are heavily repeated, so each distinct one is
+        # only stored once
+        self._manufacturers = []
+        self._manufacturer_ids = {}
+        self._listing_manufacturers = array('I')
+        # The searchable titles, UTF-8 encoded and concatenated
+        self._titles = bytearray()
+        self._title_ends = array('L')
+
+    def append(self, listing):
+        '''Adds the fields of `listing` (which must have an offset) to the
+        table.'''
+        self.offsets.append(listing.offset)
+        self.lengths.append(listing.length)
+
+        manufacturer_id = self._manufacturer_ids.get(listing.manufacturer)
+        if manufacturer_id is None:
+            manufacturer_id = len(self._manufacturers)
+            self._manufacturers.append(listing.manufacturer)
+            self._manufacturer_ids[listing.manufacturer] = manufacturer_id
+        self._listing_manufacturers.append(manufacturer_id)
+
+        self._titles.extend(listing.searchable_title.encode('utf8'))
+        self._title_ends.append(len(self._titles))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        title_begin = self._title_ends[i - 1] if i else 0
+        return Listing.from_fields(
+            self.offsets[i], self.lengths[i],
+            self._manufacturers[self._listing_manufacturers[i]],
+            self._titles[title_begin:self._title_ends[i]].decode('utf8'))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
 
 
 class Product(object):
+    __slots__ = ('orig_data', 'product_name', 'manufacturer', 'model', 'family',
+                 'listings', 'listing_offsets', 'listing_lengths',
+                 '_matcher', '_token_matchers', '_number_match_allowed')
+
     def __init__(self, jsonstring):
         self.orig_data = jsonstring
         jsondata = json.loads(jsonstring)
@@ -99,39 +568,89 @@ class Product(object):
             self.family = None
 
         self.listings = []
+        # Byte spans (within the listings source file) of associated listings
+        # that are not being kept in memory; see `associate_listing_span`
+        self.listing_offsets = array('L')
+        self.listing_lengths = array('I')
 
     def associate_listing(self, listing):
-        '''Adds a listing to the list of associated (matching) listings'''
-        self.listings.append(listing)
+        '''Adds a listing to the list of associated (matching) listings. If
+        the listing's data was not kept, it is recorded by its location
+        instead (see `associate_listing_span`).'''
+        if listing.orig_data is None:
+            self.associate_listing_span(listing.offset, listing.length)
+        else:
+            self.listings.append(listing)
 
+    @property
+    def has_listings(self):
+        return bool(self.listings or self.listing_offsets)
+
+    def associate_listing_span(self, offset, length):
+        '''Records an associated (matching) listing by the location of its
+        JSON string within the listings source file, rather than keeping the
+        `Listing` object itself.'''
+        self.listing_offsets.append(offset)
+        self.listing_lengths.append(length)
+
+    def _listings_data(self, source=None):
+        '''Yields the JSON string of each associated listing: first those
+        kept in memory, then those associated by span, which are read from
+        `source` (as buffers onto it, if it is an mmap).'''
+        for L in self.listings:
+            yield L.orig_data.strip()
+        for offset, length in izip(self.listing_offsets, self.listing_lengths):
+            yield read_span(source, offset, length)
 
     @property
     def result_json(self):
         '''JSON string giving the product_name and an array of associated
         listings, formatted with one listing per line.'''
-
-        output = '{"product_name": "' + self.product_name.encode('utf8') + '", "listings": [\n'
-        if self.listings:
-            for L in self.listings[:-1]:
-                output += L.orig_data.strip() + ',\n'
-            output += self.listings[-1].orig_data.strip()
-        output += '\n]}\n'
-        return output
+        return ''.join(self._json_parts(
+            (L.orig_data.strip() for L in self.listings),
+            '{"product_name": "', '", "listings": [\n', ',\n', '\n]}\n'
+        ))
 
     @property
     def result_json_compact(self):
         '''JSON string giving the product_name and an array of associated
         listings, formatted as a single line with no superfluous
         whitespace.'''
+        return ''.join(self._compact_json_parts(L.orig_data.strip() for L in self.listings))
 
-        output = '{"product_name":"' + self.product_name.encode('utf8') + '","listings":['
-        if self.listings:
-            for L in self.listings[:-1]:
-                output += L.orig_data.strip() + ','
-            output += self.listings[-1].orig_data.strip()
-        output += ']}\n'
-        return output
+    def write_result_json_compact(self, output, source=None):
+        '''Writes `result_json_compact` (including any listings associated by
+        span, from `source`) to the file `output`. If `source` is an mmap, the
+        listings are written straight from it, without being copied into an
+        intermediate string.'''
+        output.writelines(self._compact_json_parts(self._listings_data(source)))
 
+    def result_json_compact_size(self):
+        '''The length, in bytes, of what `write_result_json_compact`
+        writes.'''
+        count = len(self.listings) + len(self.listing_lengths)
+        size = sum(len(part) for part in self._compact_json_parts(()))
+        size += sum(len(L.orig_data.strip()) for L in self.listings)
+        size += sum(self.listing_lengths)
+        # (plus the separating commas)
+        return size + max(count - 1, 0)
+
+    def _compact_json_parts(self, listings_data):
+        return self._json_parts(listings_data, '{"product_name":"', '","listings":[', ',', ']}\n')
+
+    def _json_parts(self, listings_data, begin, middle, separator, end):
+        '''Returns a list of the strings (or buffers) that make up a result
+        object, when written one after another, for the given iterable of
+        listing JSON strings.'''
+        parts = [begin + self.product_name.encode('utf8') + middle]
+        for data in listings_data:
+            parts.append(data)
+            parts.append(separator)
+        if len(parts) > 1:
+            parts[-1] = end
+        else:
+            parts.append(end)
+        return parts
 
     @classmethod
     def _convert_model_to_regex_string(cls, model, ignorable=[], optional_prefix=None):
@@ -163,6 +682,12 @@ class Product(object):
         model = re.sub(r'([^\W\d_])(\d)', r'\1\W*\2', model, flags=re.U)
         model = re.sub(r'(\d)([^\W\d_])', r'\1\W*\2', model, flags=re.U)
 
+        # Where the above leaves '\W*'s next to each other (e.g. for " / " in
+        # the model string), merge them: they can match no more than one does,
+        # but backtrack through every way of splitting a run of punctuation
+        # between them
+        model = _simplified_pattern(model)
+
         # This is a tricky decision: Should the tail be \D or \b?
         #
         # \D allows letter suffixes, which appear to commonly be insignificant
@@ -181,6 +706,27 @@ class Product(object):
         `ignorable` as optional components for a match'''
         self._create_holistic_regex(ignorable)
         self._create_token_regexes(ignorable)
+        self._prepare_sanity_check()
+
+    def _prepare_sanity_check(self):
+        '''Works out the parts of the sanity check (see `is_sane_match`)
+        that only depend on the product.'''
+        # A match of nothing but a number is allowed if that's really all we
+        # have to go on
+        self._number_match_allowed = bool(_re_short_number.match(self.model)) and not self.family
+
+    def is_sane_match(self, title, begin, length):
+        '''Runs a sanity check on a match of `length` characters from `begin`
+        in the searchable `title`, to make sure it's not matching something
+        too insubstantial. Returns True if it's deemed valid.'''
+        # A single character should never be enough to constitute a match.
+        if length < 2:
+            return False
+        # If all we matched was a number, don't count it as a match ... unless
+        # that's really all we have to go on.
+        if self._number_match_allowed:
+            return True
+        return not _re_short_number_span.match(title, begin, begin + length)
 
     def _create_holistic_regex(self, ignorable=[]):
         '''Initialises the matcher for this product, treating any substrings
@@ -247,33 +793,89 @@ class Product(object):
             self._token_matchers.append(Matcher(Product._convert_model_to_regex_string(tok), required))
 
 
-    def match_listing(self, listing):
+    def prepared_data(self):
+        '''Returns the product's prepared matchers (see `prepare_matchers`) in
+        a form suitable for JSON serialisation.'''
+        return {
+            'matcher': self._matcher.to_data(),
+            'token_matchers': [m.to_data() for m in self._token_matchers],
+        }
+
+    def load_prepared_data(self, data):
+        '''Prepares the product for matching using matchers previously saved
+        with `prepared_data`, instead of calling `prepare_matchers`.'''
+        self._matcher = Matcher.from_data(data['matcher'])
+        self._token_matchers = [Matcher.from_data(d) for d in data['token_matchers']]
+        self._prepare_sanity_check()
+
+    @property
+    def prefilter_requirements(self):
+        '''A list of the alternative lists of strings that a listing's
+        searchable title could contain for it to possibly match this product:
+        it must contain all of the strings of at least one of them. (An empty
+        list means that any listing could match.) Only valid once the product
+        has been prepared for matching.'''
+        alternatives = [self._matcher.keys]
+
+        if self._token_matchers:
+            required = [m for m in self._token_matchers if m.required]
+            if required:
+                # Every required token must match
+                alternatives.append([key for m in required for key in m.keys])
+            else:
+                # At least one token must match (otherwise the match would be
+                # empty, and would fail the sanity check)
+                alternatives += [m.keys for m in self._token_matchers]
+
+        return alternatives
+
+    def match_listing(self, listing, stats=None, bound=None, memo=None):
         '''Determines if `listing` matches this product. If it does, this
         returns a `ProductMatch` object representing the match. If it does
-        not, returns None.'''
+        not, returns None. If `stats` (a `MatchStats`) is given, the calls,
+        hits and time taken for each stage of the matching are recorded in
+        it. If `bound` is given, as a (begin, -length) tuple (see
+        `MatchRanking.bound`), None is also returned if the match would not
+        sort before it. If `memo` (a dict) is given, the results of the regex
+        searches are shared through it with other products matching the same
+        listing (see `Matcher.search`).'''
 
-        match = None
+        title = listing.searchable_title
 
         # First check if it matches the holistic matcher
-        m = self._matcher.re.search(listing.searchable_title)
+        if stats is not None:
+            start = time.time()
+        span = self._matcher.search(title, memo)
+        if stats is not None:
+            stats.record(MatchStats.HOLISTIC, span, start)
 
-        if m:
-            span = m.span()
-            match = ProductMatch(self, listing, span[0], span[1] - span[0])
+        if span:
+            begin, end = span
             # Do a sanity check here, so that if it fails, we fall through to
             # the token matchers.
-            match = match.sanity_check()
+            if stats is not None:
+                start = time.time()
+            sane = self.is_sane_match(title, begin, end - begin)
+            if stats is not None:
+                stats.record(MatchStats.SANITY_CHECK, sane, start)
+            if sane:
+                # The token matchers won't be tried, so there's no beating the
+                # bound
+                if bound is not None and (begin, begin - end) >= bound:
+                    return None
+                return ProductMatch(self, listing, begin, end - begin)
 
-        if not match and self._token_matchers:
+        if self._token_matchers:
             # Search for segments of model id separately
+            if stats is not None:
+                start = time.time()
             amount_matched = 0
             still_matching = True
-            mstart = len(listing.searchable_title)
+            mstart = len(title)
 
             for matcher in self._token_matchers:
-                m = matcher.re.search(listing.searchable_title)
-                if m:
-                    span = m.span()
+                span = matcher.search(title, memo)
+                if span:
                     mlength = span[1] - span[0]
                     if mlength:
                         amount_matched += mlength
@@ -282,12 +884,59 @@ class Product(object):
                     still_matching = False
                     break
 
+            if stats is not None:
+                stats.record(MatchStats.TOKENS, still_matching, start)
+
+            if still_matching and bound is not None and (mstart, -amount_matched) >= bound:
+                still_matching = False
+
             if still_matching:
                 # Matched all required segments
-                match = ProductMatch(self, listing, mstart, amount_matched)
-                match = match.sanity_check()
+                if stats is not None:
+                    start = time.time()
+                sane = self.is_sane_match(title, mstart, amount_matched)
+                if stats is not None:
+                    stats.record(MatchStats.SANITY_CHECK, sane, start)
+                if sane:
+                    return ProductMatch(self, listing, mstart, amount_matched)
+
+        return None
+
+    def scan_titles(self, blob):
+        '''Like calling `match_listing` for each of the titles of a
+        `TitleBlob`, but running each of the product's regexes only once, over
+        all of the titles together. Yields an (index, begin, length) tuple for
+        each title that the product matches.'''
+        titles = blob.titles
+
+        matched = set()
+        for i, (begin, end) in blob.first_spans(self._matcher.re).iteritems():
+            if self.is_sane_match(titles[i], begin, end - begin):
+                matched.add(i)
+                yield i, begin, end - begin
 
-        return match
+        if not self._token_matchers:
+            return
+
+        token_spans = [blob.first_spans(matcher.re) for matcher in self._token_matchers]
+        required = [set(spans) for (matcher, spans) in
+                    izip(self._token_matchers, token_spans) if matcher.required]
+        if required:
+            # Titles that matched all required segments
+            candidates = set.intersection(*required)
+        else:
+            candidates = set().union(*token_spans)
+
+        for i in candidates - matched:
+            amount_matched = 0
+            mstart = len(titles[i])
+            for spans in token_spans:
+                span = spans.get(i)
+                if span is not None and span[1] > span[0]:
+                    amount_matched += span[1] - span[0]
+                    mstart = min(mstart, span[0])
+            if self.is_sane_match(titles[i], mstart, amount_matched):
+                yield i, mstart, amount_matched
 
 
 class Manufacturer(object):
@@ -295,6 +944,8 @@ class Manufacturer(object):
         self.name = name
         self.products = []
         self.known_families = set()
+        # Model segments marked as optional by `prepare_regexes`
+        self.ignorable_segments = set()
         for P in products:
             self.add_product(P)
 
@@ -306,17 +957,56 @@ class Manufacturer(object):
             if '-' in product.family:
                 self.known_families.add(product.family.replace('-', ''))
 
-    def find_matching_products(self, listing):
+    def find_matching_products(self, listing, candidates=None, profile=None, ranking=None, deadline=None):
         '''Returns a list containing a `ProductMatch` object for each of the
-        products from this manufacturer that match `listing`.'''
+        products from this manufacturer that match `listing`. If given,
+        `candidates` is the list of products to be tried (such as that
+        returned by `CatalogIndex.candidate_products`); otherwise every
+        product is tried. If a `MatchProfile` is given, the
+        matching is recorded in it. If a `MatchRanking` is given, the matches
+        are added to it, and only those that would be kept by it are
+        returned. If a `Deadline` is given, no more products are tried once
+        it has passed.'''
+        if profile is not None:
+            start = time.time()
+        if candidates is None:
+            candidates = self.products
         matches = []
-        for P in self.products:
-            match = P.match_listing(listing)
+        # The regex search results for the listing, shared by the products
+        # (whose matchers are interned; see `_intern_matchers`)
+        memo = {}
+        for P in candidates:
+            if deadline is not None and deadline.passed():
+                break
+            bound = ranking.bound if ranking is not None else None
+            if profile is not None:
+                match = P.match_listing(listing, profile.product_stats(P), bound, memo)
+            else:
+                match = P.match_listing(listing, bound=bound, memo=memo)
             if match:
                 matches.append(match)
+                if ranking is not None:
+                    ranking.add(match)
 
+        if profile is not None:
+            profile.record_manufacturer(self.name, len(candidates), len(matches), start)
         return matches
 
+    def scan_titles(self, titles):
+        '''Finds the best-matching product for each of a batch of searchable
+        titles, by running each product's regexes once over all of them (see
+        `Product.scan_titles`), rather than trying each title in turn.
+        Returns a list giving, for each title, a (begin, length, product)
+        tuple for its best match (chosen as by `MatchRanking`), or None.'''
+        blob = TitleBlob(titles)
+        best = [None] * len(titles)
+        for P in self.products:
+            for i, begin, length in P.scan_titles(blob):
+                current = best[i]
+                if current is None or (begin, -length) < (current[0], -current[1]):
+                    best[i] = (begin, length, P)
+        return best
+
     def prepare_regexes(self, verbose=False):
         '''Does some analysis of the model strings for the products of this
         manufacturer, then prepares the `Product` objects for matching
@@ -360,5 +1050,487 @@ class Manufacturer(object):
                         num=len(self.products)
                     ))
 
+        self.ignorable_segments = ignorable_segments
         for P in self.products:
             P.prepare_matchers(ignorable_segments)
+
+        self._intern_matchers()
+
+    def prepared_data(self):
+        '''Returns the results of `prepare_regexes` for this manufacturer and
+        its products, in a form suitable for JSON serialisation.'''
+        return {
+            'ignorable_segments': sorted(self.ignorable_segments),
+            'known_families': sorted(self.known_families),
+            'products': [P.prepared_data() for P in self.products],
+        }
+
+    def load_prepared_data(self, data):
+        '''Prepares the manufacturer and its products for matching using data
+        previously saved with `prepared_data`, instead of calling
+        `prepare_regexes`. The manufacturer must have the same products, in
+        the same order, as when the data was saved.'''
+        if len(data['products']) != len(self.products):
+            raise ValueError('Prepared data for {man} does not match its products'.format(
+                man=self.name.encode('utf8')))
+
+        self.ignorable_segments = set(data['ignorable_segments'])
+        self.known_families = set(data['known_families'])
+        for P, product_data in zip(self.products, data['products']):
+            P.load_prepared_data(product_data)
+
+        self._intern_matchers()
+
+    def _intern_matchers(self):
+        '''Makes the products' matchers that have the same pattern (and are
+        alike in being required or not) share a single `Matcher`, so that its
+        regex is only compiled once. Family names and common words such as
+        "powershot" or "ii" are tokens of many products, and the holistic
+        patterns of different products can be the same.'''
+        matchers = {}
+        for P in self.products:
+            P._matcher = matchers.setdefault((P._matcher.pattern, P._matcher.required), P._matcher)
+            P._token_matchers = [matchers.setdefault((matcher.pattern, matcher.required), matcher)
+                                 for matcher in P._token_matchers]
+
+    def analyze_regexes(self, limit=REGEX_COST_LIMIT):
+        '''Times each of the products' (interned) regexes searching titles
+        chosen to be slow for it (see `_stress_titles`), and returns a list of
+        (pattern, cost) tuples for those that take more than `limit` seconds
+        on any of them, slowest first. The timings depend on the machine and
+        its load, so this is only a guide to the regexes worth looking at.'''
+        matchers = []
+        seen = set()
+        for P in self.products:
+            for matcher in [P._matcher] + P._token_matchers:
+                if id(matcher) not in seen:
+                    seen.add(id(matcher))
+                    matchers.append(matcher)
+
+        costly = []
+        for matcher in matchers:
+            cost = matcher.search_cost(_stress_titles(matcher.pattern))
+            if cost > limit:
+                costly.append((matcher.pattern, cost))
+        costly.sort(key=lambda item: -item[1])
+        return costly
+
+class TitleBlob(object):
+    '''A batch of searchable titles, joined by newlines into a single string
+    so that a regex can be run over all of them in one scan.'''
+    def __init__(self, titles):
+        self.titles = titles
+        self.text = u'\n'.join(titles)
+        self.starts = []
+        # The spans found for each pattern, so that each is only run once
+        self._spans = {}
+        pos = 0
+        for title in titles:
+            self.starts.append(pos)
+            pos += len(title) + 1
+
+    def first_spans(self, regex):
+        '''Returns a dict mapping the index of each title in which the
+        compiled `regex` matches to the (begin, end) span of the match that
+        `regex.search` would find in that title alone. The dict is shared by
+        all callers passing a regex with the same pattern, and must not be
+        modified.
+
+        A match found in the joined text is the same as the one found in the
+        title alone, unless it reached (or looked ahead to) the newline at the
+        end of the title: the model regexes only look up to three characters
+        past the end of the match. The titles where that might have happened,
+        and any titles that such a match ran into, are searched alone
+        instead.'''
+        spans = self._spans.get(regex.pattern)
+        if spans is not None:
+            return spans
+        titles = self.titles
+        starts = self.starts
+        text = self.text
+        spans = self._spans[regex.pattern] = {}
+        recheck = []
+
+        pos = 0
+        while True:
+            m = regex.search(text, pos)
+            if m is None:
+                break
+            begin, end = m.span()
+            i = bisect_right(starts, begin) - 1
+            line_start = starts[i]
+            line_end = line_start + len(titles[i])
+            if end + 3 >= line_end:
+                recheck.append(i)
+            else:
+                spans[i] = (begin - line_start, end - line_start)
+            # Only the first match in each title is wanted, so carry on from
+            # the start of the next title the match didn't reach into
+            last = i
+            if end > line_end:
+                last = bisect_right(starts, end - 1) - 1
+                recheck.extend(range(i + 1, last + 1))
+            if last + 1 >= len(titles):
+                break
+            pos = starts[last + 1]
+
+        for i in recheck:
+            m = regex.search(titles[i])
+            if m:
+                spans[i] = m.span()
+        return spans
+
+
+class LRUCache(object):
+    '''A dict-like cache holding at most `size` items, which discards the
+    least recently used items to make room for new ones. Counts the hits and
+    misses of `get`.
+
+    The items are kept in two generations, recently used and older, and when
+    the recent generation is full the older one is discarded and replaced by
+    it (an item in the older generation moves back to the recent one when it
+    is used). This approximates strict LRU order using only plain dict
+    operations, which are fast, and atomic, so that the items can be shared
+    between threads without a lock. The .hits and .misses counts are not
+    updated atomically, though, so with several threads they are only
+    approximate.'''
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._recent = {}
+        self._old = {}
+
+    def get(self, key, default=None):
+        value = self._recent.get(key, _missing)
+        if value is _missing:
+            value = self._old.pop(key, _missing)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if len(self._recent) >= max(self.size // 2, 1):
+            self._old = self._recent
+            self._recent = {}
+        self._recent[key] = value
+
+    def __len__(self):
+        return len(self._recent) + len(self._old)
+
+
+class CatalogIndex(object):
+    '''An inverted index over all of the products of a set of (prepared)
+    manufacturers, along with the manufacturer and family names. A listing's
+    title is searched once to find the candidate products of every
+    manufacturer, rather than once per manufacturer. The index must be rebuilt
+    if the manufacturers or their products change.
+
+    The index also remembers the manufacturers found for recently seen
+    listing manufacturer strings (in .manufacturer_cache, filled by the
+    caller) and title starts (by `find_manufacturers_in_title`), as listings
+    tend to repeat a small number of them, and the outcome of matching
+    recently seen listings, with the span of the title matched (in
+    .match_cache, also filled by the caller).
+
+    If .time_limit is set, the caller stops trying a listing's products once
+    it has spent that many seconds on them, and adds the listing's
+    (manufacturer, searchable title) to .capped_listings rather than
+    remembering its outcome.
+
+    .engine_timings maps the name of each manufacturer to the total [seconds,
+    titles] that each engine has taken to match batches of its listings (also
+    filled by the caller).'''
+    def __init__(self, manufacturers, cache_size=RESOLUTION_CACHE_SIZE,
+                 match_cache_size=MATCH_CACHE_SIZE):
+        self.manufacturer_cache = LRUCache(cache_size)
+        self._title_cache = LRUCache(cache_size)
+        self.match_cache = LRUCache(match_cache_size)
+        self.time_limit = None
+        self.capped_listings = []
+        self.engine_timings = {}
+        self._products = []
+        # The range of indices into self._products of each manufacturer's
+        # products
+        self._product_ranges = {}
+        # Each product is indexed by the longest key of each of its
+        # `prefilter_requirements`, and has a mask of the bits for all of the
+        # keys of each; a listing's signature has the bits for all of the keys
+        # in its title
+        self._key_index = KeywordIndex()
+        self._key_bits = {}
+        self._anchored = {}
+        self._unanchored = set()
+        self._masks = []
+        self._name_index = KeywordIndex()
+
+        for rank, M in enumerate(manufacturers.itervalues()):
+            # Name entries carry the manufacturer's position in `manufacturers`
+            # (see `find_manufacturers_in_title`)
+            self._name_index.add(_longest_alnum_run(M.name), (rank, M.name, M))
+            for family in M.known_families:
+                self._name_index.add(_longest_alnum_run(family), (None, family, M))
+
+            first = len(self._products)
+            for P in M.products:
+                self._add_product(P)
+            self._product_ranges[M] = (first, len(self._products))
+
+        self._key_index.compile()
+        self._name_index.compile()
+
+    def _add_product(self, product):
+        i = len(self._products)
+        self._products.append(product)
+        alternatives = product.prefilter_requirements
+        if not all(alternatives):
+            # Products that can't be prefiltered are always candidates
+            self._unanchored.add(i)
+            self._masks.append(None)
+            return
+
+        masks = []
+        for keys in alternatives:
+            mask = 0
+            for key in keys:
+                if key not in self._key_bits:
+                    self._key_bits[key] = 1 << len(self._key_bits)
+                    self._key_index.add(key, key)
+                mask |= self._key_bits[key]
+            if mask not in masks:
+                masks.append(mask)
+            self._anchored.setdefault(max(keys, key=len), set()).add(i)
+        self._masks.append(masks)
+
+    def candidate_products(self, listing, manufacturers):
+        '''Returns a dict mapping each of the given manufacturers to a list of
+        its products (in order) that could possibly match `listing`.'''
+        keys = self._key_index.find(listing.searchable_title)
+        signature = 0
+        found = set(self._unanchored)
+        for key in keys:
+            signature |= self._key_bits[key]
+            if key in self._anchored:
+                found.update(self._anchored[key])
+
+        candidates = {}
+        for M in manufacturers:
+            first, last = self._product_ranges[M]
+            candidates[M] = [self._products[i] for i in sorted(
+                i for i in found if first <= i < last and self._admits(i, signature))]
+        return candidates
+
+    def _admits(self, i, signature):
+        '''Returns True if the product at index `i` could match a listing with
+        the given signature: if the signature has all of the bits of one of
+        its masks.'''
+        masks = self._masks[i]
+        if masks is None:
+            return True
+        for mask in masks:
+            if signature & mask == mask:
+                return True
+        return False
+
+    def find_manufacturers_in_title(self, title_start):
+        '''Returns a set containing the manufacturer whose name is present in
+        `title_start`, or, if there is none, the manufacturers with a known
+        family name present in it. Where several manufacturer names are
+        present, the one that came first in the dict of manufacturers the
+        index was built from is chosen. The same set is returned for repeated
+        calls, so it must not be modified.'''
+        found = self._title_cache.get(title_start)
+        if found is None:
+            found = self._find_manufacturers_in_title(title_start)
+            self._title_cache[title_start] = found
+        return found
+
+    def _find_manufacturers_in_title(self, title_start):
+        named = None
+        families = set()
+        for (rank, string, M) in self._name_index.find(title_start):
+            if string not in title_start:
+                continue
+            if rank is None:
+                families.add(M)
+            elif named is None or rank < named[0]:
+                named = (rank, M)
+
+        if named:
+            return set([named[1]])
+        return families
+
+    def cache_stats(self):
+        '''Returns a dict giving the number of hits, misses and entries of
+        the manufacturer string, title start and match caches.'''
+        return dict((name, {'hits': cache.hits, 'misses': cache.misses, 'entries': len(cache)})
+                    for (name, cache) in [('manufacturer', self.manufacturer_cache),
+                                          ('title', self._title_cache),
+                                          ('match', self.match_cache)])
+
+    def take_capped_listings(self):
+        '''Returns the list of .capped_listings recorded so far, and starts a
+        new one.'''
+        capped = self.capped_listings
+        self.capped_listings = []
+        return capped
+
+
+class MatchStats(object):
+    '''The number of calls and hits, and the cumulative time taken, for each
+    stage of matching listings against a product (see
+    `Product.match_listing`), as gathered when profiling.'''
+    __slots__ = ('calls', 'hits', 'times')
+
+    # The stages
+    HOLISTIC = 0
+    TOKENS = 1
+    SANITY_CHECK = 2
+    STAGE_NAMES = ('holistic', 'tokens', 'sanity_check')
+
+    def __init__(self):
+        self.calls = [0, 0, 0]
+        self.hits = [0, 0, 0]
+        self.times = [0.0, 0.0, 0.0]
+
+    def record(self, stage, hit, start):
+        '''Records a call to the given stage that began at time `start` (and
+        ends now), and whether it was a hit (or passed, for the sanity
+        check).'''
+        self.times[stage] += time.time() - start
+        self.calls[stage] += 1
+        if hit:
+            self.hits[stage] += 1
+
+    @property
+    def total_time(self):
+        return sum(self.times)
+
+    def to_data(self):
+        data = {}
+        for stage, name in enumerate(self.STAGE_NAMES):
+            data[name] = {
+                'calls': self.calls[stage],
+                'hits': self.hits[stage],
+                'rejects': self.calls[stage] - self.hits[stage],
+                'time': self.times[stage],
+            }
+        return data
+
+    def merge_data(self, data):
+        '''Adds the counts and times from the output of `to_data`.'''
+        for stage, name in enumerate(self.STAGE_NAMES):
+            self.calls[stage] += data[name]['calls']
+            self.hits[stage] += data[name]['hits']
+            self.times[stage] += data[name]['time']
+
+
+class MatchProfile(object):
+    '''A profile of the matching of listings against products, gathered when
+    profiling is enabled: a `MatchStats` for each product tried, the number of
+    calls, candidate products tried, matches found and time taken for each
+    manufacturer, and the time taken by each phase of the run.'''
+    def __init__(self):
+        # Keyed by product_name
+        self.products = {}
+        self.product_manufacturers = {}
+        # Keyed by manufacturer name; [calls, candidates, matches, time]
+        self.manufacturers = {}
+        self.phases = {}
+
+    def product_stats(self, product):
+        '''Returns the `MatchStats` for `product`, creating it if need be.'''
+        stats = self.products.get(product.product_name)
+        if stats is None:
+            stats = self.products[product.product_name] = MatchStats()
+            self.product_manufacturers[product.product_name] = product.manufacturer
+        return stats
+
+    def _manufacturer_record(self, name):
+        record = self.manufacturers.get(name)
+        if record is None:
+            record = self.manufacturers[name] = [0, 0, 0, 0.0]
+        return record
+
+    def record_manufacturer(self, name, candidates, matches, start):
+        '''Records a search of the manufacturer's products, which began at
+        time `start` (and ends now).'''
+        record = self._manufacturer_record(name)
+        record[0] += 1
+        record[1] += candidates
+        record[2] += matches
+        record[3] += time.time() - start
+
+    def record_phase(self, phase, start):
+        '''Records that a phase of the run began at time `start`, and ends
+        now.'''
+        self.phases[phase] = self.phases.get(phase, 0.0) + time.time() - start
+
+    def to_data(self):
+        '''Returns the profile in a form suitable for JSON serialisation.'''
+        products = {}
+        for name, stats in self.products.iteritems():
+            products[name] = stats.to_data()
+            products[name]['manufacturer'] = self.product_manufacturers[name]
+            products[name]['time'] = stats.total_time
+        manufacturers = {}
+        for name, (calls, candidates, matches, total_time) in self.manufacturers.iteritems():
+            manufacturers[name] = {
+                'calls': calls,
+                'candidates': candidates,
+                'matches': matches,
+                'time': total_time,
+            }
+        return {
+            'phases': self.phases,
+            'manufacturers': manufacturers,
+            'products': products,
+        }
+
+    def merge_data(self, data):
+        '''Adds the counts and times from the output of `to_data` (such as
+        that of another process).'''
+        for phase, phase_time in data['phases'].iteritems():
+            self.phases[phase] = self.phases.get(phase, 0.0) + phase_time
+        for name, product_data in data['products'].iteritems():
+            stats = self.products.get(name)
+            if stats is None:
+                stats = self.products[name] = MatchStats()
+                self.product_manufacturers[name] = product_data['manufacturer']
+            stats.merge_data(product_data)
+        for name, m in data['manufacturers'].iteritems():
+            record = self._manufacturer_record(name)
+            record[0] += m['calls']
+            record[1] += m['candidates']
+            record[2] += m['matches']
+            record[3] += m['time']
+
+    def write_report(self, output, top=20):
+        '''Writes a summary of the profile to the file `output`: the time
+        taken by each phase, and the `top` manufacturers and products that
+        took the most time to match.'''
+        output.write('\nProfile:\n')
+        for phase, phase_time in sorted(self.phases.items(), key=lambda item: item[1], reverse=True):
+            output.write('{0:10.3f}s  {1}\n'.format(phase_time, phase))
+
+        output.write('\nSlowest manufacturers ({0} of {1}):\n'.format(
+            min(top, len(self.manufacturers)), len(self.manufacturers)))
+        output.write('{0:>11}  {1:>8}  {2:>10}  {3:>8}  {4}\n'.format(
+            'time', 'calls', 'candidates', 'matches', 'manufacturer'))
+        by_time = sorted(self.manufacturers.items(), key=lambda item: item[1][3], reverse=True)
+        for name, (calls, candidates, matches, total_time) in by_time[:top]:
+            output.write('{0:10.3f}s  {1:8}  {2:10}  {3:8}  {4}\n'.format(
+                total_time, calls, candidates, matches, name.encode('utf8')))
+
+        output.write('\nSlowest products ({0} of {1}), with calls/hits for each stage:\n'.format(
+            min(top, len(self.products)), len(self.products)))
+        output.write('{0:>11}  {1:>13}  {2:>13}  {3:>13}  {4}\n'.format(
+            'time', 'holistic', 'tokens', 'sanity_check', 'product'))
+        by_time = sorted(self.products.items(), key=lambda item: item[1].total_time, reverse=True)
+        for name, stats in by_time[:top]:
+            counts = ['{0}/{1}'.format(calls, hits) for (calls, hits) in zip(stats.calls, stats.hits)]
+            output.write('{0:10.3f}s  {1:>13}  {2:>13}  {3:>13}  {4}\n'.format(
+                stats.total_time, counts[0], counts[1], counts[2], name.encode('utf8')))
@@ -1,20 +1,33 @@
 #!/usr/bin/env python
 # -*- coding: utf8 -*-
 
+from collections import Counter, OrderedDict
+from itertools import izip_longest
 import argparse
+import heapq
 import json
+import multiprocessing
+import re
 import sys
 import traceback
+import zlib
 
 
 DEFAULT_OUTPUT_FILE = 'results.diff'
 
+# The start of a line of a results file, up to the product_name string
+_re_result_head = re.compile(r'\s*\{\s*"product_name"\s*:\s*')
+
+_decoder = json.JSONDecoder()
+
 
 class Result(object):
     # count = 0
 
-    def __init__(self, jsonstring):
+    def __init__(self, jsonstring, index=None):
         self.orig_data = jsonstring
+        # The position of the result among those in its file
+        self.index = index
         # print Result.count
         # Result.count += 1
         jsondata = json.loads(jsonstring)
@@ -37,14 +50,12 @@ class ComparableListing(object):
         self.manufacturer = jsondata['manufacturer'].lower()
         self.price = jsondata['price']
         self.currency = jsondata['currency']
-        self.matched = False
 
-    def __eq__(self, list2):
-        return (self.title == list2.title and
-                self.manufacturer == list2.manufacturer and
-                self.currency == list2.currency and
-                self.price == list2.price
-                )
+    @property
+    def key(self):
+        '''The fields that identify the listing; listings are equal if their
+        keys are.'''
+        return (self.title, self.manufacturer, self.currency, self.price)
 
 
 
@@ -57,7 +68,9 @@ def parse_my_arguments(arguments=None):
             per line, grouped together by product. Each block begins with name
             of the product. Listings for that product present only in the first
             file are shown with "- " at the start of the line, and listings
-            present only in the second file are preceded by "+ ".'''
+            present only in the second file are preceded by "+ ". A summary of
+            the numbers of listings removed, added and moved between products
+            is written to stderr.'''
     )
     parser.add_argument(
         'results_a',
@@ -77,6 +90,12 @@ def parse_my_arguments(arguments=None):
         help='''write the differences between the results to this file
             (default is "results.diff")'''
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int, metavar='N', default=1,
+        help='''compare the results in parallel in N processes, each taking
+            a share of the products'''
+    )
 
     if arguments is not None:
         if isinstance(arguments, list):
@@ -91,53 +110,240 @@ def parse_my_arguments(arguments=None):
     return args
 
 
-def read_results_data(results_file):
-    results = {}
-    # Read and structure the data
-    for rj in results_file:
-        R = Result(rj)
-        results[R.product_name] = R
+def result_product_name(rj):
+    '''Returns the product_name of a line of a results file, without decoding
+    the rest of it.'''
+    m = _re_result_head.match(rj)
+    if m:
+        return _decoder.raw_decode(rj, m.end())[0]
+    return json.loads(rj)['product_name']
+
+
+def product_partition(product_name, partitions):
+    '''Returns the partition (out of `partitions`) that a product belongs to,
+    for comparing in parallel.'''
+    return zlib.crc32(product_name.encode('utf8')) % partitions
+
+
+def partition_results(results_file, partitions):
+    '''Reads through a results file, decoding only the product names, and
+    returns a list for each of the `partitions` giving the (index, offset,
+    length) of each of the results for its products.'''
+    lines = [[] for k in range(partitions)]
+    index = offset = 0
+    for rj in iter(results_file.readline, ''):
+        if rj.strip():
+            partition = product_partition(result_product_name(rj), partitions)
+            lines[partition].append((index, offset, len(rj)))
+            index += 1
+        offset += len(rj)
+    return lines
+
+
+def iter_results_data(results_file, lines=None):
+    '''Yields a `Result` for each line of the results file, in order, with
+    its index among the results in the file. If `lines` is given (a list from
+    `partition_results`), only those results are read, by their offsets, so
+    the file should be unbuffered.'''
+    if lines is None:
+        index = 0
+        for rj in results_file:
+            if rj.strip():
+                yield Result(rj, index)
+                index += 1
+    else:
+        for index, offset, length in lines:
+            results_file.seek(offset)
+            yield Result(results_file.read(length), index)
+
+
+def diff_listings(listings_a, listings_b):
+    '''Returns a list of the listings in `listings_a` that aren't in
+    `listings_b`, and a list of those in `listings_b` that aren't in
+    `listings_a`, each in their original order. Where a listing appears more
+    often in one than the other, its later occurrences are the ones
+    returned.'''
+    remaining_b = Counter(L.key for L in listings_b)
+    removed = []
+    for L in listings_a:
+        if remaining_b[L.key] > 0:
+            remaining_b[L.key] -= 1
+        else:
+            removed.append(L)
+
+    remaining_a = Counter(L.key for L in listings_a)
+    added = []
+    for L in listings_b:
+        if remaining_a[L.key] > 0:
+            remaining_a[L.key] -= 1
+        else:
+            added.append(L)
+
+    return removed, added
+
 
-    results_file.close()
-    return results
+def compare_results(results_a, results_b):
+    '''Compares two sequences of `Result`s, and yields a (key, product_name,
+    removed listings, added listings) tuple for each product (as found by
+    `diff_listings`). Products missing from one of the sequences are treated
+    as having no listings there.
+
+    The products are yielded in order of their keys, whatever order they are
+    found in: first those in `results_a`, in their order there, with the key
+    (0, index in results_a), then those only in `results_b`, in their order
+    there, with the key (1, index in results_b). So the products of a
+    partition of the results come in the same order as they would among all
+    the results. The sequences are read in step, so if the products come in
+    the same order in both, only one product from each is held at a time.'''
+    # Results read from one sequence that haven't yet been found in the other
+    pending_a = OrderedDict()
+    pending_b = OrderedDict()
+    # The comparisons of the products in results_a, in order, with None for
+    # those not yet found in results_b; each is yielded once those before it
+    # have been
+    compared = OrderedDict()
+
+    def compare(Ra, Rb):
+        compared[Ra.product_name] = ((0, Ra.index), Ra.product_name) + \
+            diff_listings(Ra.listings, Rb.listings)
+
+    for Ra, Rb in izip_longest(results_a, results_b):
+        if Ra is not None and Rb is not None and Ra.product_name == Rb.product_name:
+            compare(Ra, Rb)
+        else:
+            if Ra is not None:
+                if Ra.product_name in pending_b:
+                    compare(Ra, pending_b.pop(Ra.product_name))
+                else:
+                    pending_a[Ra.product_name] = Ra
+                    compared[Ra.product_name] = None
+            if Rb is not None:
+                if Rb.product_name in pending_a:
+                    compare(pending_a.pop(Rb.product_name), Rb)
+                else:
+                    pending_b[Rb.product_name] = Rb
+        while compared:
+            name = next(iter(compared))
+            if compared[name] is None:
+                break
+            yield compared.pop(name)
+
+    for name, Ra in pending_a.iteritems():
+        compared[name] = ((0, Ra.index), name, list(Ra.listings), [])
+    for comparison in compared.itervalues():
+        yield comparison
+    for name, Rb in pending_b.iteritems():
+        yield (1, Rb.index), name, [], list(Rb.listings)
+
+
+class ComparisonSummary(object):
+    '''Counts of the differences between two results files.'''
+    def __init__(self):
+        self.products = 0
+        self.products_changed = 0
+        # Keys of the listings removed from, and added to, each product
+        self.removed = Counter()
+        self.added = Counter()
+
+    def add(self, removed, added):
+        self.products += 1
+        if removed or added:
+            self.products_changed += 1
+        self.removed.update(L.key for L in removed)
+        self.added.update(L.key for L in added)
+
+    def merge(self, other):
+        self.products += other.products
+        self.products_changed += other.products_changed
+        self.removed.update(other.removed)
+        self.added.update(other.added)
+
+    @property
+    def moved(self):
+        '''The number of listings removed from one product and added to
+        another.'''
+        return sum(min(count, self.added[key]) for (key, count) in self.removed.iteritems())
+
+    def write(self, output):
+        moved = self.moved
+        output.write('Compared {0} products; {1} differ:\n'.format(self.products, self.products_changed))
+        output.write('{0:6} listings moved between products,\n'.format(moved))
+        output.write('{0:6} listings removed (no longer matched),\n'.format(sum(self.removed.itervalues()) - moved))
+        output.write('{0:6} listings added (newly matched)\n'.format(sum(self.added.itervalues()) - moved))
+
+
+def format_diff(name, removed, added):
+    '''Returns the diff output for a product, or an empty string if it has
+    no differences.'''
+    if not removed and not added:
+        return ''
+    lines = [name.encode('utf8') + ":\n"]
+    lines += ["- " + L.title.encode('utf8') + "\n" for L in removed]
+    lines += ["+ " + L.title.encode('utf8') + "\n" for L in added]
+    return ''.join(lines)
+
+
+def compare_files(file_a, file_b, summary, lines_a=None, lines_b=None):
+    '''Compares two open results files (or, if `lines_a` and `lines_b` are
+    given, only those of their results; see `iter_results_data`), adding each
+    product to the `ComparisonSummary`. Yields the key (see
+    `compare_results`) and diff output of each product that differs, as soon
+    as it is found.'''
+    for key, name, removed, added in compare_results(iter_results_data(file_a, lines_a),
+                                                     iter_results_data(file_b, lines_b)):
+        summary.add(removed, added)
+        diff = format_diff(name, removed, added)
+        if diff:
+            yield key, diff
+
+
+def _compare_partition(task):
+    '''Worker process function for comparing a partition of the products,
+    reading only their results from the files. Returns a list of the keys and
+    diff outputs of the products that differ, and a `ComparisonSummary`.'''
+    filename_a, filename_b, lines_a, lines_b = task
+    summary = ComparisonSummary()
+    with open(filename_a, 'rb', 0) as file_a, open(filename_b, 'rb', 0) as file_b:
+        diffs = list(compare_files(file_a, file_b, summary, lines_a, lines_b))
+    return diffs, summary
 
 
 def main(arguments=None):
     args = parse_my_arguments(arguments)
 
-    results_a = read_results_data(args.results_a)
-    results_b = read_results_data(args.results_b)
-
-    for name, R in results_a.iteritems():
-        if name in results_b:
-            Rb = results_b[name]
-
-            for L in R.listings:
-                for Lb in Rb.listings:
-                    if Lb.matched:
-                        continue
-                    if L == Lb:
-                        L.matched = True
-                        Lb.matched = True
-                        break
-
-        first_diff = True
-        for L in R.listings:
-            if not L.matched:
-                if first_diff:
-                    args.output.write(name.encode('utf8') + ":\n")
-                    first_diff = False
-                args.output.write("- " + L.title.encode('utf8') + "\n")
-
-        if name in results_b:
-            for Lb in Rb.listings:
-                if not Lb.matched:
-                    if first_diff:
-                        args.output.write(name.encode('utf8') + ":\n")
-                        first_diff = False
-                    args.output.write("+ " + Lb.title.encode('utf8') + "\n")
+    summary = ComparisonSummary()
+    # Each worker reads its partition's results from both files itself, so
+    # they must be files that can be opened again by name, rather than stdin
+    if args.jobs > 1 and sys.stdin not in (args.results_a, args.results_b):
+        lines_a = partition_results(args.results_a, args.jobs)
+        lines_b = partition_results(args.results_b, args.jobs)
+        args.results_a.close()
+        args.results_b.close()
+        pool = multiprocessing.Pool(args.jobs)
+        try:
+            tasks = [(args.results_a.name, args.results_b.name, lines_a[k], lines_b[k])
+                     for k in range(args.jobs)]
+            compared = pool.map(_compare_partition, tasks)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        # The diffs of each partition are in order of their keys, so merging
+        # them by key gives the order of a comparison in a single process
+        for key, diff in heapq.merge(*[diffs for (diffs, partition_summary) in compared]):
+            args.output.write(diff)
+        for diffs, partition_summary in compared:
+            summary.merge(partition_summary)
+    else:
+        for key, diff in compare_files(args.results_a, args.results_b, summary):
+            args.output.write(diff)
+        args.results_a.close()
+        args.results_b.close()
 
     args.output.close()
+    summary.write(sys.stderr)
 
 
 
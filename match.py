@@ -4,15 +4,84 @@
 # Solution to the Sortable Coding Challenge at
 # http://sortable.com/blog/coding-challenge/
 
-from classes import Product, Listing, Manufacturer
+from classes import Product, Listing, ListingTable, Manufacturer, CatalogIndex, \
+    MatchProfile, MatchRanking, Deadline, MATCHING_RULES_VERSION, REGEX_COST_LIMIT, read_span
+from reader import open_input, is_mapped, iter_blocks, block_lines, iter_lines, \
+    read_lines, split_chunks
+from collections import OrderedDict
+from itertools import izip, islice
 import argparse
+import hashlib
+import heapq
+import json
+import mmap
+import multiprocessing
+import os
+import Queue
+import re
+import stat
 import sys
+import tempfile
+import threading
+import time
 import traceback
 
 DEFAULT_PRODUCTS_FILE = 'data/products.txt'
 DEFAULT_LISTINGS_FILE = 'data/listings.txt'
 DEFAULT_RESULTS_FILE = 'data/results.txt'
 
+# Patterns for the structure of a line of a results file
+_re_results_head = re.compile(r'\s*\{\s*"product_name"\s*:\s*')
+_re_results_listings = re.compile(r'\s*,\s*"listings"\s*:\s*\[\s*')
+_re_results_separator = re.compile(r'\s*([,\]])\s*')
+
+# How listings are matched by `match_listings_to_products`: 'auto', 'scan' or
+# 'listing' (see `plan_engine`)
+DEFAULT_ENGINE = 'auto'
+
+# The number of listings that `match_listings_to_products` matches together
+# as a batch, which bounds the memory the batch holds at once
+BATCH_SIZE = 4096
+
+# The number of titles that each engine is tried on for a manufacturer before
+# `plan_engine` compares how long they took
+PLAN_SAMPLE_TITLES = 32
+
+# Number of chunks the listings are split into for each worker process, so
+# that the work stays evenly balanced if some chunks are slower than others
+CHUNKS_PER_WORKER = 4
+
+# The size of the blocks of listings passed between the stages of a pipelined
+# run, and the number of blocks that may be waiting between two stages
+PIPELINE_BLOCK_SIZE = 1 << 18
+PIPELINE_QUEUE_SIZE = 8
+
+# The outcomes of `match_listing_to_product` for listings that don't match
+UNKNOWN_MANUFACTURER = 'unknown manufacturer'
+UNKNOWN_MODEL = 'unknown model'
+
+
+class OutputFileType(argparse.FileType):
+    '''Like `argparse.FileType('w')`, but opens the file without truncating
+    it, so that it can be checked before anything is lost (see
+    `parse_my_arguments`).'''
+    def __init__(self):
+        argparse.FileType.__init__(self, 'a')
+
+    def __call__(self, string):
+        if string == '-':
+            return sys.stdout
+        return argparse.FileType.__call__(self, string)
+
+
+def positive_float(string):
+    '''An argparse type for a number (of seconds, say) that must be greater
+    than zero.'''
+    value = float(string)
+    if not value > 0:
+        raise argparse.ArgumentTypeError('{0} is not greater than 0'.format(string))
+    return value
+
 
 def parse_my_arguments(arguments=None):
     '''Processes the arguments to the command using argparse and returns the
@@ -36,22 +105,127 @@ def parse_my_arguments(arguments=None):
     parser.add_argument(
         '-l', '--listings',
         type=argparse.FileType('r'), metavar='LISTINGS_FILE',
-        default=DEFAULT_LISTINGS_FILE,
-        help='file containing JSON objects (one per line) containing the listings'
+        help='''file containing JSON objects (one per line) containing the
+                listings (default is {0}; not used in incremental
+                mode)'''.format(DEFAULT_LISTINGS_FILE)
     )
     parser.add_argument(
         '-r', '--results',
-        type=argparse.FileType('w'), metavar='RESULTS_FILE',
+        type=OutputFileType(), metavar='RESULTS_FILE',
         default=DEFAULT_RESULTS_FILE,
         help='''write results to this file (one JSON object per line, naming a
                 product and giving an array of matched listings objects)'''
     )
+    parser.add_argument(
+        '-u', '--unmatched',
+        type=OutputFileType(), metavar='UNMATCHED_FILE',
+        help='''write listings that could not be matched to any product to
+                this file (one JSON object per line)'''
+    )
+    parser.add_argument(
+        '--previous-products',
+        type=argparse.FileType('r'), metavar='PREVIOUS_PRODUCTS_FILE',
+        help='''incremental mode: the products file used to produce
+                PREVIOUS_RESULTS_FILE; only listings that could be affected by
+                the changes from it to PRODUCTS_FILE are matched again, and
+                LISTINGS_FILE is not used (nor are --stream, --pipeline and
+                --engine)'''
+    )
+    parser.add_argument(
+        '--previous-results',
+        type=argparse.FileType('r'), metavar='PREVIOUS_RESULTS_FILE',
+        help='''incremental mode: results file from a previous run'''
+    )
+    parser.add_argument(
+        '--previous-unmatched',
+        type=argparse.FileType('r'), metavar='PREVIOUS_UNMATCHED_FILE',
+        help='''incremental mode: file of unmatched listings written by the
+                previous run with --unmatched (required, so that they can be
+                matched again)'''
+    )
+    parser.add_argument(
+        '-c', '--cache',
+        metavar='CACHE_FILE',
+        help='''cache the products, prepared for matching, in this file; if
+                the cache is valid for PRODUCTS_FILE, it is used instead of
+                preparing the products again'''
+    )
+    parser.add_argument(
+        '--rebuild-cache',
+        action='store_true',
+        help='''prepare the products and (re)write CACHE_FILE, then exit
+                without matching any listings'''
+    )
     parser.add_argument(
         '--suppress-empty',
         action='store_true',
         help='''in results file, do not include results objects for products
                 that have no matched listings'''
     )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='''match listings one at a time as they are read (use "-" as the
+                LISTINGS_FILE to read from stdin), keeping only the locations
+                of matched listings in memory rather than the listings
+                themselves'''
+    )
+    parser.add_argument(
+        '--profile',
+        type=OutputFileType(), metavar='PROFILE_FILE',
+        help='''profile the matching: record how often each product's
+                matchers and sanity check are called and succeed, and the time
+                spent in each (and in each manufacturer, and phase of the run),
+                write the profile to this file as JSON, and write a report of
+                the slowest manufacturers and products to stderr'''
+    )
+    parser.add_argument(
+        '--profile-top',
+        type=int, metavar='N', default=20,
+        help='number of manufacturers and products to include in the profile report (default is 20)'
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int, metavar='N', default=1,
+        help='''match listings in parallel using N worker processes (listings
+                are matched by location in the same way as with --stream), and
+                write the results file in parallel too, if it is a regular
+                file'''
+    )
+    parser.add_argument(
+        '--engine',
+        choices=['auto', 'scan', 'listing'],
+        help='''how to match the listings (unless they are matched by
+                location): 'listing' tries each listing against its candidate
+                products in turn, 'scan' runs each product's regexes once over
+                the titles of a batch of listings for its manufacturer, and
+                'auto' (the default) tries both for each manufacturer and then
+                uses whichever was faster; the results are the same'''
+    )
+    parser.add_argument(
+        '--analyze-regexes',
+        action='store_true',
+        help='''time each of the prepared regexes against titles chosen to be
+                slow for it, and report on stderr any that take more than
+                {0:.0f}us to search one'''.format(REGEX_COST_LIMIT * 1e6)
+    )
+    parser.add_argument(
+        '--time-limit',
+        type=positive_float, metavar='SECONDS',
+        help='''stop matching a listing once this many seconds have been
+                spent on it, and use the best match found by then; the
+                listings cut short are reported on stderr (the limit is
+                checked before each product is tried, so a single slow regex
+                search is not cut short; see --analyze-regexes)'''
+    )
+    parser.add_argument(
+        '--pipeline',
+        choices=['thread', 'process'],
+        help='''read, match and write the listings in overlapping stages
+                connected by bounded queues, with N matcher threads or
+                processes (see --workers); listings are matched by location
+                in the same way as with --stream'''
+    )
 
     if arguments is not None:
         if isinstance(arguments, list):
@@ -63,15 +237,57 @@ def parse_my_arguments(arguments=None):
     else:
         args = parser.parse_args()
 
+    if args.workers < 1:
+        parser.error('the number of workers must be at least 1')
+
+    if args.rebuild_cache and not args.cache:
+        parser.error('--rebuild-cache requires --cache')
+
+    if args.previous_products or args.previous_results or args.previous_unmatched:
+        # (without the previous unmatched listings, they would silently be
+        # left out of the results)
+        if not (args.previous_products and args.previous_results and args.previous_unmatched):
+            parser.error('incremental mode requires --previous-products, --previous-results '
+                         'and --previous-unmatched')
+        unsupported = [name for (name, value) in [('--listings', args.listings),
+                                                  ('--stream', args.stream),
+                                                  ('--pipeline', args.pipeline),
+                                                  ('--engine', args.engine)] if value]
+        if unsupported:
+            parser.error('incremental mode does not use {0}'.format(', '.join(unsupported)))
+    elif args.listings is None:
+        # (opened here, so that incremental mode doesn't need the file)
+        try:
+            args.listings = open(DEFAULT_LISTINGS_FILE, 'r')
+        except IOError as e:
+            parser.error("can't open '{0}': {1}".format(DEFAULT_LISTINGS_FILE, e))
+
+    if args.engine is None:
+        args.engine = DEFAULT_ENGINE
+
+    # The output files are opened without truncating them, so that they can
+    # first be checked against the input files
+    inputs = [f for f in (args.products, args.listings, args.previous_products,
+                          args.previous_results, args.previous_unmatched)
+              if f and is_regular_file(f)]
+    for output in (args.results, args.unmatched, args.profile):
+        if output and is_regular_file(output):
+            for f in inputs:
+                if os.path.sameopenfile(f.fileno(), output.fileno()):
+                    parser.error('{0} is both an input and an output file'.format(output.name))
+            # (stdout, given as '-', is written as it was opened)
+            if output is not sys.stdout:
+                output.truncate(0)
+
     return args
 
 
 def read_products_data(products_file):
-    '''Reads product data from the passed file handle, creates corresponding
-    `Product` objects, and (as needed) `Manufacturer` objects storing lists of
-    associated `Product`s. Returns a list containing all of the `Product`s, in
-    the order they were read, and a dict containing all of the
-    `Manufacturer`s, keyed by their names.'''
+    '''Reads product data from the passed file handle (or list of JSON
+    strings), creates corresponding `Product` objects, and (as needed)
+    `Manufacturer` objects storing lists of associated `Product`s. Returns a
+    list containing all of the `Product`s, in the order they were read, and a
+    dict containing all of the `Manufacturer`s, keyed by their names.'''
     manufacturers = {}
     products = []
     # Read and structure the data
@@ -85,23 +301,157 @@ def read_products_data(products_file):
     return products, manufacturers
 
 
-def read_listings_data(listings_file):
-    '''Reads listing data from the passed file handle, creates and returns a
-    list of corresponding `Listing` objects'''
-    listings = []
-    for lj in listings_file:
-        L = Listing(lj)
-        listings.append(L)
+def products_digest(products_data):
+    '''Returns a hex digest identifying the given product data (a list of
+    JSON strings) along with the version of the matching rules, for use in
+    validating a catalog cache.'''
+    digest = hashlib.sha1('rules-version {0}\n'.format(MATCHING_RULES_VERSION))
+    for pj in products_data:
+        digest.update(pj)
+    return digest.hexdigest()
+
+
+def save_catalog_cache(cache_filename, digest, manufacturers):
+    '''Writes the prepared manufacturers to the cache file, identified by
+    `digest` (see `products_digest`).'''
+    cache = {
+        'version': MATCHING_RULES_VERSION,
+        'products_digest': digest,
+        'manufacturers': dict(
+            (name, M.prepared_data()) for (name, M) in manufacturers.iteritems()
+        ),
+    }
+    # Write to a temporary file first, so that a partially written cache is
+    # never seen by another run
+    cache_dir = os.path.dirname(os.path.abspath(cache_filename))
+    with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+        json.dump(cache, f)
+    # (temporary files are only readable by their owner)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(f.name, 0666 & ~umask)
+    os.rename(f.name, cache_filename)
+
+
+def load_catalog_cache(cache_filename, digest, manufacturers, verbose=False):
+    '''Prepares the manufacturers for matching using the cache file, if it
+    exists and is valid for `digest` (see `products_digest`). Returns True
+    if the cache was used, or False if the manufacturers still need to be
+    prepared (as they do if the cache is truncated or malformed, which is
+    reported if `verbose` is set).'''
+    try:
+        with open(cache_filename, 'rb') as f:
+            cache = json.load(f)
+        if cache.get('version') != MATCHING_RULES_VERSION or \
+                cache.get('products_digest') != digest or \
+                set(cache['manufacturers']) != set(manufacturers):
+            return False
+
+        for name, M in manufacturers.iteritems():
+            M.load_prepared_data(cache['manufacturers'][name])
+    except IOError:
+        return False
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        if verbose:
+            sys.stderr.write('Ignoring unreadable cache {0}: {1}\n'.format(cache_filename, e))
+        return False
+    return True
+
+
+def prepare_catalog(products_data, manufacturers, cache_filename=None, rebuild=False, verbose=False):
+    '''Prepares the manufacturers for matching, as `prepare_manufacturers`
+    does, but using the catalog cache file if one is given and it is valid for
+    `products_data` (the JSON strings the products were read from). Otherwise,
+    or if `rebuild` is set, the manufacturers are prepared from scratch and
+    the cache file is (re)written. Returns a `CatalogIndex` of the prepared
+    manufacturers.'''
+    if cache_filename:
+        digest = products_digest(products_data)
+        if not rebuild and load_catalog_cache(cache_filename, digest, manufacturers, verbose):
+            if verbose:
+                sys.stderr.write('Loaded prepared products from {0}\n'.format(cache_filename))
+            return CatalogIndex(manufacturers)
+
+    index = prepare_manufacturers(manufacturers, verbose=verbose)
+
+    if cache_filename:
+        if verbose:
+            sys.stderr.write('Saving prepared products to {0}\n'.format(cache_filename))
+        save_catalog_cache(cache_filename, digest, manufacturers)
+    return index
+
+
+def read_listings_data(listings_file, spool=None):
+    '''Reads listing data from the passed file handle (or source returned by
+    `open_input`), and returns a `ListingTable` of the corresponding
+    listings. Only the location of each listing's data within the file is
+    kept. If `spool` is given, all of the data read is also copied to it (see
+    `iter_listings_data`).'''
+    listings = ListingTable()
+    for offset, block in iter_blocks(listings_file):
+        if spool is not None:
+            spool.write(block)
+        for offset, lj in block_lines(offset, block):
+            listings.append(Listing(lj, offset, keep_data=False))
     return listings
 
 
-def find_manufacturers_for_listing(listing, manufacturers):
+def iter_listings_data(listings_file, spool=None):
+    '''Reads listing data from the passed file handle (or source returned by
+    `open_input`) a block at a time, yielding a corresponding `Listing`
+    object for each line. The byte offset of each listing within the file is
+    stored in its `offset` attribute. If `spool` is given, all of the data
+    read is also copied to it, so that listings read from a pipe can be read
+    back later.'''
+    # Note: blocks are read as they become available, so lines arriving on a
+    # pipe are processed without waiting for a whole block
+    for offset, block in iter_blocks(listings_file):
+        if spool is not None:
+            spool.write(block)
+        for offset, lj in block_lines(offset, block):
+            yield Listing(lj, offset)
+
+
+def is_regular_file(f):
+    '''Returns True if the file object `f` refers to a regular (and thus
+    seekable) file, rather than a pipe, terminal or similar.'''
+    try:
+        return stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+    except (AttributeError, ValueError, OSError):
+        return False
+
+
+def is_reopenable_file(f):
+    '''Returns True if the file object `f` is a regular file that can be
+    opened again by its name (unlike, say, stdout redirected to a file).'''
+    try:
+        return is_regular_file(f) and os.path.samestat(os.stat(f.name), os.fstat(f.fileno()))
+    except (AttributeError, TypeError, OSError):
+        return False
+
+
+def map_file(f):
+    '''Returns a read-only mmap of the regular file `f`, or `f` itself if it
+    can't be mapped (if it's empty, for instance).'''
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        return f
+
+
+def find_manufacturers_for_listing(listing, manufacturers, index=None, profile=None):
     '''Returns a set (usually containing one item, but potentially more) of
     manufacturers that are believed to correspond to the listing. Each of the
-    manufacturers should be searched for a product match.'''
+    manufacturers should be searched for a product match. If a `CatalogIndex`
+    of the manufacturers is given, it is used to search the listing title. If
+    a `MatchProfile` is given, the time taken is recorded in it.'''
+    if profile is not None:
+        start = time.time()
+        manufacturers_to_search = find_manufacturers_for_listing(listing, manufacturers, index)
+        profile.record_phase('resolve_manufacturers', start)
+        return manufacturers_to_search
 
     L = listing
-    manufacturers_to_search = set()
 
     # First, a quick check if there's an exact match for the listing's
     # 'manufacturer' field
@@ -109,22 +459,23 @@ def find_manufacturers_for_listing(listing, manufacturers):
         manufacturers_to_search = [manufacturers[L.manufacturer]]
 
     # Second, see if a known manufacturer name is at least present in the
-    # listing's 'manufacturer' field.
-    #
-    # e.g., matching 'canon' to 'canon canada inc.'
-    if not manufacturers_to_search:
-        # Search a bit more thoroughly
-        for (name, M) in manufacturers.iteritems():
-            if name in L.manufacturer:
-                manufacturers_to_search = set([M])
-                break
-            elif L.manufacturer and L.manufacturer in name:
-                manufacturers_to_search.add(M)
+    # listing's 'manufacturer' field (see `find_manufacturers_in_field`).
+    elif index is not None:
+        # The same few manufacturer strings turn up again and again, so the
+        # index remembers what was found for each
+        manufacturers_to_search = index.manufacturer_cache.get(L.manufacturer)
+        if manufacturers_to_search is None:
+            manufacturers_to_search = find_manufacturers_in_field(L.manufacturer, manufacturers)
+            index.manufacturer_cache[L.manufacturer] = manufacturers_to_search
+    else:
+        manufacturers_to_search = find_manufacturers_in_field(L.manufacturer, manufacturers)
 
     # Third, check for the presence of a manufacturer name or product family
     # name in the first three words of the listing title.
     if not manufacturers_to_search:
         title_start = ' '.join(L.searchable_title.split()[:3])
+        if index is not None:
+            return index.find_manufacturers_in_title(title_start)
         for (name, M) in manufacturers.iteritems():
             if name in title_start:
                 manufacturers_to_search = set([M])
@@ -136,87 +487,1031 @@ def find_manufacturers_for_listing(listing, manufacturers):
     return manufacturers_to_search
 
 
-def match_listings_to_products(listings, manufacturers, verbose=False):
-    '''Finds, if possible, the best-matching product for each listing, and
-    associates that listing with the matched product.'''
+def find_manufacturers_in_field(manufacturer, manufacturers):
+    '''The second step of `find_manufacturers_for_listing`: returns a set of
+    the manufacturers whose name is present in the listing's `manufacturer`
+    field (or, if there are none, whose name contains it).'''
+    manufacturers_to_search = set()
+
+    # See if a known manufacturer name is at least present in the listing's
+    # 'manufacturer' field.
+    #
+    # e.g., matching 'canon' to 'canon canada inc.'
+    for (name, M) in manufacturers.iteritems():
+        if name in manufacturer:
+            manufacturers_to_search = set([M])
+            break
+        elif manufacturer and manufacturer in name:
+            manufacturers_to_search.add(M)
+
+    return manufacturers_to_search
 
-    # Tracking these for evaluation purposes
-    unknown_manufacturer = []
-    unknown_model = []
 
+def prepare_manufacturers(manufacturers, verbose=False):
+    '''Prepares all of the manufacturers (and their products) for matching.
+    Returns a `CatalogIndex` of the prepared manufacturers.'''
     if verbose:
         sys.stderr.write('Preparing manufacturer and product data for matching...\n')
     for M in manufacturers.itervalues():
         M.prepare_regexes(verbose=verbose)
+    return CatalogIndex(manufacturers)
+
+
+def find_top_matches(listing, manufacturers_to_search, k, index=None, profile=None, deadline=None):
+    '''Compares the listing to the products of each of the given
+    manufacturers, and returns a list of `ProductMatch`es for the (up to) `k`
+    best-matching products, best first. If a `CatalogIndex` is given, only the
+    candidate products it finds are compared. If a `MatchProfile` is given,
+    the matching is recorded in it. If a `Deadline` is given, the best of
+    the matches found before it passes are returned.'''
+    # The best match is the one:
+    # 1) whose match starts earliest in the listing
+    # 2) with the longest matching amount of text
+    # Products that can't beat the kth best found so far are rejected as
+    # soon as that is known.
+    ranking = MatchRanking(k)
+
+    if index is not None:
+        if profile is not None:
+            start = time.time()
+        candidates = index.candidate_products(listing, manufacturers_to_search)
+        if profile is not None:
+            profile.record_phase('find_candidates', start)
+        for M in manufacturers_to_search:
+            M.find_matching_products(listing, candidates[M], profile, ranking, deadline)
+    else:
+        for M in manufacturers_to_search:
+            M.find_matching_products(listing, profile=profile, ranking=ranking, deadline=deadline)
+
+    return ranking.matches()
+
+
+def find_best_match(listing, manufacturers_to_search, index=None, profile=None, deadline=None):
+    '''Compares the listing to the products of each of the given
+    manufacturers, and returns a `ProductMatch` for the best-matching product,
+    or None if no products match. See `find_top_matches`.'''
+    matches = find_top_matches(listing, manufacturers_to_search, 1, index, profile, deadline)
+    return matches[0] if matches else None
+
+
+def find_best_match_in_time(listing, manufacturers_to_search, index=None, profile=None):
+    '''Like `find_best_match`, but if a `CatalogIndex` with a time limit is
+    given, stops trying products once the listing has taken that long
+    (having tried at least one). Returns the best match found by then (or
+    None), and whether any products were skipped.
+
+    The limit is only checked before each product is tried, so a single slow
+    regex search (see `Manufacturer.analyze_regexes`) is not cut short.'''
+    if index is None or index.time_limit is None:
+        return find_best_match(listing, manufacturers_to_search, index, profile), False
+    deadline = Deadline(index.time_limit)
+    best_match = find_best_match(listing, manufacturers_to_search, index, profile, deadline)
+    return best_match, deadline.skipped
+
+
+def top_matches_for_listing(listing, manufacturers, k, index=None, profile=None):
+    '''Returns a list of `ProductMatch`es for the (up to) `k` products that
+    best match the listing, best first; the first is the match that
+    `match_listing_to_product` would choose. The list is empty if there are
+    no matching products, or if the manufacturer is unknown. If a
+    `CatalogIndex` is given, the manufacturers are assumed to have already
+    been prepared for matching.'''
+    manufacturers_to_search = find_manufacturers_for_listing(listing, manufacturers, index, profile)
+    if not manufacturers_to_search:
+        return []
+    return find_top_matches(listing, manufacturers_to_search, k, index, profile)
+
+
+def top_matches_for_listings(listings, manufacturers, k, index=None, profile=None):
+    '''Yields a (listing, list of `ProductMatch`es) tuple for each of the
+    listings, giving its top `k` matches (see `top_matches_for_listing`). The
+    manufacturers are prepared for matching first, unless a `CatalogIndex` is
+    given.'''
+    if index is None:
+        index = prepare_manufacturers(manufacturers)
+    for L in listings:
+        yield L, top_matches_for_listing(L, manufacturers, k, index, profile)
+
+
+def match_listing(listing, manufacturers, index=None, profile=None):
+    '''Finds the product that best matches the listing. Returns an
+    (outcome, begin, length) tuple, where the outcome is the `Product`, or
+    UNKNOWN_MANUFACTURER or UNKNOWN_MODEL if there is none, and begin and
+    length give the span of the listing's searchable title that the product
+    matched (both None if there is no product).
+
+    The outcome only depends on the listing's manufacturer and searchable
+    title, which listings repeat a lot (differing only in price, for
+    instance). So if a `CatalogIndex` is given, it remembers the outcome for
+    each, and a listing with the same manufacturer and searchable title as
+    one seen recently is given the same outcome without being matched
+    again.
+
+    If the index has a time limit, it applies to the listing (see
+    `find_best_match_in_time`). A listing cut short by it is added to the
+    index's .capped_listings, and its outcome is not remembered.'''
+    if index is not None:
+        key = (listing.manufacturer, listing.searchable_title)
+        match = index.match_cache.get(key)
+        if match is not None:
+            return match
+
+    capped = False
+    manufacturers_to_search = find_manufacturers_for_listing(listing, manufacturers, index, profile)
+    if not manufacturers_to_search:
+        match = (UNKNOWN_MANUFACTURER, None, None)
+    else:
+        best_match, capped = find_best_match_in_time(listing, manufacturers_to_search, index, profile)
+        if best_match:
+            match = (best_match.product, best_match.begin, best_match.length)
+        else:
+            match = (UNKNOWN_MODEL, None, None)
+
+    if capped:
+        # (a later duplicate of the listing may be given the time it needs)
+        index.capped_listings.append(key)
+    elif index is not None:
+        index.match_cache[key] = match
+    return match
+
+
+def match_listing_to_product(listing, manufacturers, index=None, profile=None):
+    '''Finds the product that best matches the listing. Returns the
+    `Product`, or UNKNOWN_MANUFACTURER or UNKNOWN_MODEL if there is none (see
+    `match_listing`).'''
+    return match_listing(listing, manufacturers, index, profile)[0]
+
+
+def plan_engine(manufacturer, index, engine='auto'):
+    '''Chooses how to match a batch of searchable titles against the products
+    of a manufacturer: 'scan', running each product's regexes once over all of
+    the titles (see `Manufacturer.scan_titles`), or 'listing', matching the
+    titles one at a time. Returns the engine, and the number of the titles to
+    match with it (or None for all of them).
+
+    If `engine` is 'auto', each is tried on PLAN_SAMPLE_TITLES of the
+    manufacturer's titles, and from then on whichever took less time per
+    title (as recorded in the index's .engine_timings by
+    `match_listings_batch`) is chosen. Both take time in proportion to the
+    number of titles, but at rates that depend on the manufacturer's regexes
+    and on the listings, so they are measured rather than estimated.'''
+    if engine != 'auto':
+        return engine, None
+    timings = index.engine_timings.get(manufacturer.name, {})
+    rates = {}
+    for candidate in ('scan', 'listing'):
+        seconds, count = timings.get(candidate, (0.0, 0))
+        if count < PLAN_SAMPLE_TITLES:
+            return candidate, PLAN_SAMPLE_TITLES - count
+        rates[candidate] = seconds / count
+    return min(rates, key=rates.get), None
+
+
+def resolve_listings_batch(listings, manufacturers, index):
+    '''The first step of `match_listings_batch`: finds the manufacturers to
+    search for each distinct listing (by manufacturer and searchable title)
+    of a batch. Returns a list of the outcomes already known from the index's
+    match_cache (None for the rest), and an OrderedDict mapping the
+    (manufacturer, searchable title) of each distinct listing still to be
+    matched to a listing, the manufacturers to search, and the positions of
+    the listings sharing its outcome.'''
+    outcomes = [None] * len(listings)
+    pending = OrderedDict()
+    for n, L in enumerate(listings):
+        key = (L.manufacturer, L.searchable_title)
+        if key in pending:
+            pending[key][2].append(n)
+            continue
+        match = index.match_cache.get(key)
+        if match is not None:
+            outcomes[n] = match[0]
+            continue
+        pending[key] = (L, find_manufacturers_for_listing(L, manufacturers, index), [n])
+    return outcomes, pending
+
+
+def match_listings_batch(listings, manufacturers, index, engine='auto', resolved=None):
+    '''Finds the outcome (as returned by `match_listing_to_product`) for each
+    of a batch of listings, returning a list of them. The distinct listings
+    (by manufacturer and searchable title) are grouped by the manufacturers
+    to be searched, and each manufacturer's group is matched with the engine
+    chosen by `plan_engine`. The outcomes are the same whichever engine is
+    used. `resolved` is what `resolve_listings_batch` returns for the
+    listings, if it has already been called.'''
+    if resolved is None:
+        resolved = resolve_listings_batch(listings, manufacturers, index)
+    outcomes, pending = resolved
+
+    groups = OrderedDict()
+    for key, (L, manufacturers_to_search, positions) in pending.iteritems():
+        for M in manufacturers_to_search:
+            groups.setdefault(M, []).append(key)
+
+    # The best match from each manufacturer, as a (begin, length, product)
+    # tuple, for each distinct listing
+    best = dict((key, {}) for key in pending)
+    for M, keys in groups.iteritems():
+        while keys:
+            chosen_engine, count = plan_engine(M, index, engine)
+            if count is not None:
+                keys, rest = keys[:count], keys[count:]
+            else:
+                rest = []
+            start = time.time()
+            if chosen_engine == 'scan':
+                for key, match in izip(keys, M.scan_titles([key[1] for key in keys])):
+                    if match is not None:
+                        best[key][M] = match
+            else:
+                for key in keys:
+                    match = find_best_match(pending[key][0], [M], index)
+                    if match is not None:
+                        best[key][M] = (match.begin, match.length, match.product)
+            if engine == 'auto':
+                timing = index.engine_timings.setdefault(M.name, {}).setdefault(chosen_engine, [0.0, 0])
+                timing[0] += time.time() - start
+                timing[1] += len(keys)
+            keys = rest
+
+    for key, (L, manufacturers_to_search, positions) in pending.iteritems():
+        if not manufacturers_to_search:
+            outcome = UNKNOWN_MANUFACTURER
+            index.match_cache[key] = (outcome, None, None)
+        else:
+            # (ties go to the manufacturer searched first, as in
+            # `find_best_match`)
+            chosen = None
+            for M in manufacturers_to_search:
+                match = best[key].get(M)
+                if match is not None and (chosen is None or (match[0], -match[1]) < (chosen[0], -chosen[1])):
+                    chosen = match
+            if chosen is not None:
+                outcome = chosen[2]
+                index.match_cache[key] = (outcome, chosen[0], chosen[1])
+            else:
+                outcome = UNKNOWN_MODEL
+                index.match_cache[key] = (outcome, None, None)
+        for n in positions:
+            outcomes[n] = outcome
+
+    return outcomes
+
+
+def iter_batches(listings, batch_size=BATCH_SIZE):
+    '''Yields lists of up to `batch_size` of the listings at a time, in
+    order.'''
+    listings = iter(listings)
+    while True:
+        batch = list(islice(listings, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def match_listings_batches(listings, manufacturers, index, engine='auto'):
+    '''Yields the outcome for each of the listings, in order, as found by
+    `match_listings_batch` for each of the batches given by `iter_batches`,
+    so that only one batch's distinct listings and outcomes are held at
+    once.'''
+    for batch in iter_batches(listings):
+        for outcome in match_listings_batch(batch, manufacturers, index, engine):
+            yield outcome
+
+
+def match_listings_to_products(listings, manufacturers, verbose=False, index=None, profile=None,
+                               engine=DEFAULT_ENGINE):
+    '''Finds, if possible, the best-matching product for each listing, and
+    associates that listing with the matched product. If a `CatalogIndex` is
+    given, the manufacturers are assumed to have already been prepared for
+    matching. If a `MatchProfile` is given, the matching is recorded in
+    it.
+
+    With the 'listing' engine (or when profiling, or with a time limit for
+    each listing), each listing is matched in turn; otherwise the listings
+    are matched in batches by `match_listings_batches`, with the engine chosen
+    by `plan_engine`.'''
+
+    # Tracking these for evaluation purposes (compactly, if the listings are
+    # stored that way)
+    if isinstance(listings, ListingTable):
+        unknown_manufacturer = ListingTable()
+        unknown_model = ListingTable()
+    else:
+        unknown_manufacturer = []
+        unknown_model = []
+
+    if index is None:
+        index = prepare_manufacturers(manufacturers, verbose=verbose)
 
     if verbose:
         sys.stderr.write('Starting the matching...\n')
-    for n, L in enumerate(listings):
+    if engine == 'listing' or profile is not None or index.time_limit is not None:
+        outcomes = (match_listing_to_product(L, manufacturers, index, profile) for L in listings)
+    else:
+        outcomes = match_listings_batches(listings, manufacturers, index, engine)
+
+    for n, (L, outcome) in enumerate(izip(listings, outcomes)):
         if verbose and n % 1000 == 0:
             sys.stderr.write('Processed {n} of {total} listings...\n'.format(
                 n=n, total=len(listings)
             ))
 
-        manufacturers_to_search = find_manufacturers_for_listing(L, manufacturers)
-
-        if not manufacturers_to_search:
+        if outcome is UNKNOWN_MANUFACTURER:
             unknown_manufacturer.append(L)
+        elif outcome is UNKNOWN_MODEL:
+            unknown_model.append(L)
+        else:
+            outcome.associate_listing(L)
+
+    if verbose:
+        write_match_summary(len(listings), len(unknown_manufacturer), len(unknown_model), index)
+    return unknown_manufacturer, unknown_model
+
+
+def match_listings_stream(listings, manufacturers, verbose=False, index=None, unmatched_file=None,
+                          profile=None):
+    '''Like `match_listings_to_products`, but consumes `listings` (any
+    iterable, such as that returned by `iter_listings_data`) one at a time,
+    and associates each matched listing with its product by byte span only, so
+    that no `Listing` objects are retained. Listings that can't be matched are
+    written to `unmatched_file` as they are found, if it is given. Returns the
+    number of listings with unknown manufacturers and the number with unknown
+    models.'''
+
+    unknown_manufacturer = 0
+    unknown_model = 0
+
+    if index is None:
+        index = prepare_manufacturers(manufacturers, verbose=verbose)
+
+    if verbose:
+        sys.stderr.write('Starting the matching...\n')
+    n = 0
+    for n, L in enumerate(listings, 1):
+        if verbose and n % 1000 == 0:
+            sys.stderr.write('Processed {n} listings...\n'.format(n=n))
+
+        outcome = match_listing_to_product(L, manufacturers, index, profile)
+
+        if outcome is UNKNOWN_MANUFACTURER or outcome is UNKNOWN_MODEL:
+            if outcome is UNKNOWN_MANUFACTURER:
+                unknown_manufacturer += 1
+            else:
+                unknown_model += 1
+            if unmatched_file:
+                write_unmatched(unmatched_file, [L])
             continue
 
-        matches = []
+        outcome.associate_listing_span(L.offset, L.length)
 
-        for M in manufacturers_to_search:
-            matches += M.find_matching_products(L)
+    if verbose:
+        write_match_summary(n, unknown_manufacturer, unknown_model, index)
+    return unknown_manufacturer, unknown_model
 
-        if not matches:
-            unknown_model.append(L)
+
+# State shared with the worker processes used by `match_listings_parallel`.
+# This is set before the worker pool is created, so that the prepared
+# manufacturers are inherited by each worker via fork rather than pickled.
+_worker_state = None
+
+
+def _match_lines(lines, profile=None):
+    '''Matches the listings given by (offset, JSON string) tuples, using the
+    prepared manufacturers in `_worker_state`. Returns a list of (offset,
+    size, product index, begin, length) tuples giving the location of each
+    matched listing, the index of its product, and the span of its
+    searchable title that the product matched, along with the number of
+    listings with unknown manufacturers and unknown models, and (if
+    requested) a list of the unmatched `Listing`s.'''
+    manufacturers, index, product_indices, keep_unmatched = _worker_state[:4]
+
+    matched = []
+    unmatched = []
+    unknown_manufacturer = 0
+    unknown_model = 0
+
+    for offset, lj in lines:
+        L = Listing(lj, offset)
+
+        outcome, begin, length = match_listing(L, manufacturers, index, profile)
+
+        if outcome is UNKNOWN_MANUFACTURER or outcome is UNKNOWN_MODEL:
+            if outcome is UNKNOWN_MANUFACTURER:
+                unknown_manufacturer += 1
+            else:
+                unknown_model += 1
+            if keep_unmatched:
+                unmatched.append(L)
             continue
 
-        if len(matches) == 1:
-            best_match = matches[0]
-        else:
-            # The best match is the one:
-            # 1) whose match starts earliest in the listing
-            # 2) with the longest matching amount of text
-            matches.sort(key=lambda m: m.length, reverse=True)
-            matches.sort(key=lambda m: m.begin)
-            best_match = matches[0]
+        matched.append((L.offset, L.length, product_indices[id(outcome)], begin, length))
+
+    return matched, unknown_manufacturer, unknown_model, unmatched
+
+
+def _match_listings_chunk(chunk):
+    '''Worker process function for `match_listings_parallel`: matches the
+    listings within a byte range of the listings file. Returns the same as
+    `_match_lines`, except that the unmatched listings are given as (offset,
+    size) tuples locating them, along with (if profiling) the chunk's profile
+    data and the listings cut short by the time limit (see
+    `match_listing_to_product`).'''
+    filename, begin, end = chunk
+    profiling = _worker_state[4]
+    profile = MatchProfile() if profiling else None
+
+    with open(filename, 'rb') as listings_file:
+        source = map_file(listings_file)
+        matched, unknown_manufacturer, unknown_model, unmatched = \
+            _match_lines(iter_lines(source, begin, end), profile)
+        source.close()
+
+    return matched, unknown_manufacturer, unknown_model, \
+        [(L.offset, L.length) for L in unmatched], \
+        profile.to_data() if profile is not None else None, \
+        _worker_state[1].take_capped_listings()
 
-        best_match.product.associate_listing(L)
+
+def match_listings_parallel(filename, products, manufacturers, workers, verbose=False, index=None,
+                            unmatched_file=None, profile=None):
+    '''Like `match_listings_stream`, but splits the listings file `filename`
+    into chunks that are matched in parallel by `workers` processes. Matched
+    listings are associated with their products by byte span, in the same
+    order as they appear in the file. Returns the number of listings with
+    unknown manufacturers and the number with unknown models.'''
+    global _worker_state
+
+    if index is None:
+        index = prepare_manufacturers(manufacturers, verbose=verbose)
+
+    with open(filename, 'rb') as listings_file:
+        source = open_input(listings_file)
+        if is_mapped(source):
+            chunks = [(filename, begin, end) for (begin, end) in
+                      split_chunks(source, workers * CHUNKS_PER_WORKER)]
+            source.close()
+        else:
+            # (the file is empty)
+            chunks = []
 
     if verbose:
-        sys.stderr.write('\nMatching completed. Processed {total:5} listings:\n{0:6} matched,\n{1:6} listings with unknown manufacturers,\n{2:6} listings for unknown models from known manufacturers\n'.format(
-            len(listings) - len(unknown_manufacturer) - len(unknown_model),
-            len(unknown_manufacturer),
-            len(unknown_model),
-            total=len(listings)
+        sys.stderr.write('Starting the matching ({0} chunks, {1} workers)...\n'.format(
+            len(chunks), workers
         ))
+
+    _worker_state = (manufacturers, index,
+                     dict((id(P), i) for (i, P) in enumerate(products)),
+                     unmatched_file is not None, profile is not None)
+    pool = multiprocessing.Pool(workers)
+    listings_file = open(filename, 'rb')
+    try:
+        total = 0
+        unknown_manufacturer = 0
+        unknown_model = 0
+        # The chunks are in file order, and imap returns them in that order,
+        # so the listings are associated in the same order as a serial run
+        for matched, chunk_unknown_manufacturer, chunk_unknown_model, unmatched, chunk_profile, capped in \
+                pool.imap(_match_listings_chunk, chunks):
+            if chunk_profile is not None:
+                profile.merge_data(chunk_profile)
+            index.capped_listings.extend(capped)
+            for (offset, size, product_index, begin, length) in matched:
+                products[product_index].associate_listing_span(offset, size)
+            for (offset, size) in unmatched:
+                listings_file.seek(offset)
+                unmatched_file.write(listings_file.read(size) + '\n')
+            total += len(matched) + chunk_unknown_manufacturer + chunk_unknown_model
+            unknown_manufacturer += chunk_unknown_manufacturer
+            unknown_model += chunk_unknown_model
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        listings_file.close()
+        _worker_state = None
+
+    if verbose:
+        write_match_summary(total, unknown_manufacturer, unknown_model)
     return unknown_manufacturer, unknown_model
 
 
-def write_results(results_file, products, suppress_empty):
+def _pipeline_reader(source, spool, tasks, matchers, errors):
+    '''Reader stage of `match_listings_pipeline`: reads blocks of listings
+    from `source` (copying them to `spool`, if given), and puts them on the
+    `tasks` queue, followed by a None for each matcher.'''
+    try:
+        for seq, (offset, block) in enumerate(iter_blocks(source, block_size=PIPELINE_BLOCK_SIZE)):
+            if spool is not None:
+                spool.write(block)
+            tasks.put((seq, offset, block))
+    except Exception:
+        errors.append(traceback.format_exc())
+    finally:
+        for i in range(matchers):
+            tasks.put(None)
+
+
+def _pipeline_matcher(tasks, results, forked=False):
+    '''Matcher stage of `match_listings_pipeline`: matches each block of
+    listings taken from the `tasks` queue (see `_match_lines`), and puts the
+    outcome on the `results` queue, with the unmatched listings as JSON
+    strings. If the matcher is a `forked` process, the listings that reached
+    the time limit are passed back too. Puts None on `results` once there are
+    no more blocks, or the traceback if matching fails.'''
+    try:
+        index = _worker_state[1]
+        profiling = _worker_state[4]
+        for seq, offset, block in iter(tasks.get, None):
+            profile = MatchProfile() if profiling else None
+            matched, unknown_manufacturer, unknown_model, unmatched = \
+                _match_lines(block_lines(offset, block), profile)
+            results.put((seq, matched, unknown_manufacturer, unknown_model,
+                         [L.orig_data.strip() for L in unmatched],
+                         profile.to_data() if profile is not None else None,
+                         index.take_capped_listings() if forked else []))
+        results.put(None)
+    except Exception:
+        results.put(traceback.format_exc())
+
+
+def _pipeline_writer(output, lines, errors):
+    '''Writer stage of `match_listings_pipeline`: writes each of the JSON
+    strings taken from the `lines` queue to `output`, one per line, until it
+    takes None.'''
+    try:
+        for data in iter(lines.get, None):
+            output.writelines((data, '\n'))
+    except Exception:
+        errors.append(traceback.format_exc())
+        # Keep taking lines, so that the matching isn't held up
+        for data in iter(lines.get, None):
+            pass
+
+
+def match_listings_pipeline(listings_source, products, manufacturers, matchers=1, matcher_type='thread',
+                            spool=None, verbose=False, index=None, unmatched_file=None, profile=None):
+    '''Like `match_listings_parallel`, but runs the reading, matching and
+    writing of listings as stages connected by bounded queues, so that
+    reading the listings from `listings_source` (see `open_input`), matching
+    them, and writing the unmatched ones to `unmatched_file` all overlap. The
+    listings are matched in blocks by `matchers` workers, which are threads
+    or (forked) processes according to `matcher_type`. If `spool` is given,
+    the listings read are copied to it. Matched listings are associated with
+    their products by byte span, in the same order as they appear in the
+    source. Returns the number of listings with unknown manufacturers and the
+    number with unknown models.'''
+    global _worker_state
+
+    if index is None:
+        index = prepare_manufacturers(manufacturers, verbose=verbose)
+
+    if matcher_type == 'process':
+        make_queue, make_worker = multiprocessing.Queue, multiprocessing.Process
+    else:
+        make_queue, make_worker = Queue.Queue, threading.Thread
+    tasks = make_queue(PIPELINE_QUEUE_SIZE)
+    results = make_queue(PIPELINE_QUEUE_SIZE)
+    unmatched_lines = Queue.Queue(PIPELINE_QUEUE_SIZE * 64)
+    errors = []
+
+    if verbose:
+        sys.stderr.write('Starting the matching ({0} {1} matchers)...\n'.format(matchers, matcher_type))
+
+    _worker_state = (manufacturers, index,
+                     dict((id(P), i) for (i, P) in enumerate(products)),
+                     unmatched_file is not None, profile is not None)
+    # (the matchers are started first, so that processes are forked before
+    # there are any other threads)
+    workers = [make_worker(target=_pipeline_matcher, args=(tasks, results, matcher_type == 'process'))
+               for i in range(matchers)]
+    stages = [threading.Thread(target=_pipeline_reader,
+                               args=(listings_source, spool, tasks, matchers, errors))]
+    if unmatched_file is not None:
+        stages.append(threading.Thread(target=_pipeline_writer,
+                                       args=(unmatched_file, unmatched_lines, errors)))
+    for worker in workers + stages:
+        worker.daemon = True
+        worker.start()
+
+    try:
+        total = 0
+        unknown_manufacturer = 0
+        unknown_model = 0
+        # Blocks may be finished out of order; hold on to them until they can
+        # be associated in order, as in a serial run
+        pending = {}
+        next_seq = 0
+        finished = 0
+        while finished < matchers:
+            outcome = results.get()
+            if outcome is None:
+                finished += 1
+                continue
+            if isinstance(outcome, basestring):
+                raise RuntimeError('Matching failed:\n' + outcome)
+            pending[outcome[0]] = outcome
+            while next_seq in pending:
+                seq, matched, block_unknown_manufacturer, block_unknown_model, unmatched, block_profile, capped = \
+                    pending.pop(next_seq)
+                next_seq += 1
+                if block_profile is not None:
+                    profile.merge_data(block_profile)
+                index.capped_listings.extend(capped)
+                for (offset, size, product_index, begin, length) in matched:
+                    products[product_index].associate_listing_span(offset, size)
+                for data in unmatched:
+                    unmatched_lines.put(data)
+                total += len(matched) + block_unknown_manufacturer + block_unknown_model
+                unknown_manufacturer += block_unknown_manufacturer
+                unknown_model += block_unknown_model
+                if verbose:
+                    sys.stderr.write('Processed {n} listings...\n'.format(n=total))
+    except:
+        if matcher_type == 'process':
+            for worker in workers:
+                worker.terminate()
+        raise
+    else:
+        unmatched_lines.put(None)
+        for worker in workers + stages:
+            worker.join()
+    finally:
+        _worker_state = None
+
+    if errors:
+        raise RuntimeError('Reading or writing listings failed:\n' + errors[0])
+    if verbose:
+        write_match_summary(total, unknown_manufacturer, unknown_model)
+    return unknown_manufacturer, unknown_model
+
+
+def parse_results_line(line):
+    '''Parses a line of a results file, as written by `write_results`.
+    Returns the product_name, and a list of the JSON strings of its listings,
+    exactly as they appear in the line.'''
+    decoder = json.JSONDecoder()
+
+    m = _re_results_head.match(line)
+    if not m:
+        raise ValueError('Unrecognised results line: ' + line[:80])
+    product_name, pos = decoder.raw_decode(line, m.end())
+
+    m = _re_results_listings.match(line, pos)
+    if not m:
+        raise ValueError('Unrecognised results line: ' + line[:80])
+    pos = m.end()
+
+    listings_data = []
+    if line[pos] != ']':
+        while True:
+            listing, end = decoder.raw_decode(line, pos)
+            listings_data.append(line[pos:end])
+            m = _re_results_separator.match(line, end)
+            if not m:
+                raise ValueError('Unrecognised results line: ' + line[:80])
+            if m.group(1) == ']':
+                break
+            pos = m.end()
+
+    return product_name, listings_data
+
+
+def read_previous_listings(results_file, unmatched_file=None):
+    '''Reads the listings from a previous run's results file and (if given)
+    unmatched listings file. Yields a tuple for each listing of the
+    product_name it was matched to (None for unmatched listings) and a
+    `Listing` object.'''
+    for line in results_file:
+        if not line.strip():
+            continue
+        product_name, listings_data = parse_results_line(line)
+        for lj in listings_data:
+            yield product_name, Listing(lj)
+
+    if unmatched_file:
+        for lj in unmatched_file:
+            if lj.strip():
+                yield None, Listing(lj)
+
+
+def changed_manufacturers(old_products, products):
+    '''Returns a set of the names of manufacturers whose products differ (in
+    any way, including their order) between the two lists of `Product`s.'''
+    def by_manufacturer(products):
+        grouped = {}
+        for P in products:
+            grouped.setdefault(P.manufacturer, []).append(P.orig_data.strip())
+        return grouped
+
+    old_grouped = by_manufacturer(old_products)
+    grouped = by_manufacturer(products)
+    return set(name for name in set(old_grouped) | set(grouped)
+               if old_grouped.get(name) != grouped.get(name))
+
+
+def rematch_incremental(previous_listings, old_manufacturers, products, manufacturers,
+                        changed, verbose=False, index=None, profile=None):
+    '''Updates the results of a previous run for a changed set of products.
+
+    `previous_listings` gives the listings and previous matches (as returned
+    by `read_previous_listings`), `old_manufacturers` the manufacturers from
+    the previous products (which need not be prepared), and `changed` the
+    names of manufacturers whose products have changed (see
+    `changed_manufacturers`).
+
+    A listing keeps its previous outcome (matched product, or no match) if
+    the manufacturers it is searched against are the same as before, and none
+    of them have changed. A manufacturer's prepared matchers (such as its
+    ignorable model segments) depend on all of its products, so any change to
+    one of them means all of its listings are matched again. Every other
+    listing is matched again.
+
+    Listings are associated with their products in the order they are read,
+    so (unlike a full run) a product's re-matched listings come after the
+    listings it kept. Returns a list of the listings that remain unmatched.'''
+
+    if index is None:
+        index = prepare_manufacturers(manufacturers, verbose=verbose)
+
+    products_by_name = dict((P.product_name, P) for P in products)
+    unmatched = []
+    total = 0
+    rematched = 0
+
+    for total, (product_name, L) in enumerate(previous_listings, 1):
+        manufacturers_to_search = find_manufacturers_for_listing(L, manufacturers, index, profile)
+        names = set(M.name for M in manufacturers_to_search)
+
+        if not names & changed and \
+                (product_name is None or product_name in products_by_name) and \
+                names == set(M.name for M in find_manufacturers_for_listing(L, old_manufacturers)):
+            # Nothing that could affect this listing has changed
+            if product_name is None:
+                unmatched.append(L)
+            else:
+                products_by_name[product_name].associate_listing(L)
+            continue
+
+        rematched += 1
+        outcome = match_listing_to_product(L, manufacturers, index, profile)
+        if outcome is UNKNOWN_MANUFACTURER or outcome is UNKNOWN_MODEL:
+            unmatched.append(L)
+        else:
+            outcome.associate_listing(L)
+
+    if verbose:
+        sys.stderr.write('\nIncremental matching completed. Matched {0} of {1} listings again; {2} listings remain unmatched\n'.format(
+            rematched, total, len(unmatched)
+        ))
+    return unmatched
+
+
+def write_match_summary(total, unknown_manufacturer, unknown_model, index=None):
+    sys.stderr.write('\nMatching completed. Processed {total:5} listings:\n{0:6} matched,\n{1:6} listings with unknown manufacturers,\n{2:6} listings for unknown models from known manufacturers\n'.format(
+        total - unknown_manufacturer - unknown_model,
+        unknown_manufacturer,
+        unknown_model,
+        total=total
+    ))
+    if index is not None:
+        stats = index.cache_stats()
+        for name in sorted(stats):
+            sys.stderr.write('{0} cache: {hits} hits, {misses} misses, {entries} entries\n'.format(
+                name.capitalize(), **stats[name]))
+
+
+def write_regex_report(manufacturers):
+    '''Reports the prepared regexes of each manufacturer that are slow to
+    search (see `Manufacturer.analyze_regexes`).'''
+    for name in sorted(manufacturers):
+        for pattern, cost in manufacturers[name].analyze_regexes():
+            sys.stderr.write(u'Slow regex for {0} ({1:.0f}us): {2}\n'.format(
+                name, cost * 1e6, pattern).encode('utf8'))
+
+
+def write_capped_listings(index):
+    '''Reports the listings whose matching was cut short by the index's time
+    limit (see `find_best_match_in_time`), if there were any.'''
+    if not index.capped_listings:
+        return
+    sys.stderr.write('{0} listings were cut short by the time limit of {1}s for matching (the best match found in time was used):\n'.format(
+        len(index.capped_listings), index.time_limit))
+    for manufacturer, title in index.capped_listings:
+        sys.stderr.write(u'\t{0}: {1}\n'.format(manufacturer, title).encode('utf8'))
+
+
+def write_unmatched(unmatched_file, listings, source=None):
+    '''Writes the JSON strings of the given listings to the file, one per
+    line. The data for listings that weren't kept is read back from
+    `source`.'''
+    for L in listings:
+        if L.orig_data is None:
+            data = read_span(source, L.offset, L.length)
+        else:
+            data = L.orig_data.strip()
+        unmatched_file.writelines((data, '\n'))
+
+
+def write_results(results_file, products, suppress_empty, source=None, workers=1):
+    '''Writes the results for each product. Listings that were associated by
+    byte span are read back from `source`. If `workers` is more than 1, and
+    the results file is a regular file that was opened by name (so that the
+    workers can open it too), the results are written in parallel (see
+    `write_results_parallel`).'''
     # products.sort(key=lambda P: P.product_name)
-    for P in products:
-        if P.listings or not suppress_empty:
-            results_file.write(P.result_json_compact)
+    products = [P for P in products if P.has_listings or not suppress_empty]
+    # (the workers can't share a file's position, so only a mapped source can
+    # be read from in parallel)
+    if workers > 1 and is_reopenable_file(results_file) and \
+            (source is None or isinstance(source, mmap.mmap)):
+        write_results_parallel(results_file, products, source, workers)
+    else:
+        for P in products:
+            P.write_result_json_compact(results_file, source)
+
+
+# State shared with the worker processes used by `write_results_parallel`,
+# inherited via fork in the same way as `_worker_state`.
+_writer_state = None
+
+
+def _write_results_shard(shard):
+    '''Worker process function for `write_results_parallel`: writes the
+    results for a range of products at the given offset within the results
+    file. Returns the number of bytes written.'''
+    filename, offset, first, last = shard
+    products, source = _writer_state
+    with open(filename, 'r+b') as results_file:
+        results_file.seek(offset)
+        for P in products[first:last]:
+            P.write_result_json_compact(results_file, source)
+        return results_file.tell() - offset
+
+
+def write_results_parallel(results_file, products, source, workers):
+    '''Writes the results for `products` to the end of the regular file
+    `results_file` (which must be reopenable by name; see
+    `is_reopenable_file`), using `workers` processes. The products are split
+    into contiguous shards of roughly equal output size, and since the size
+    of each product's results is known in advance, each shard is written
+    directly to its own place in the file.'''
+    global _writer_state
+
+    sizes = [P.result_json_compact_size() for P in products]
+    total = sum(sizes)
+    results_file.flush()
+    begin = os.fstat(results_file.fileno()).st_size
+
+    shards = []
+    first = 0
+    offset = begin
+    shard_size = 0
+    for i, size in enumerate(sizes):
+        shard_size += size
+        if shard_size * workers >= total or i == len(sizes) - 1:
+            shards.append((results_file.name, offset, first, i + 1))
+            first = i + 1
+            offset += shard_size
+            shard_size = 0
+    if not shards:
+        return
+
+    results_file.truncate(begin + total)
+    _writer_state = (products, source)
+    pool = multiprocessing.Pool(min(workers, len(shards)))
+    try:
+        written = pool.map(_write_results_shard, shards)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _writer_state = None
+
+    if sum(written) != total:
+        raise IOError('wrote {0} bytes of results to {1}, rather than {2}'.format(
+            sum(written), results_file.name, total))
 
 
 def main(arguments=None):
     args = parse_my_arguments(arguments)
 
+    profile = MatchProfile() if args.profile else None
+    start = time.time()
+
     if args.verbose:
         sys.stderr.write('Reading data...\n')
 
-    products, manufacturers = read_products_data(args.products)
+    products_data = read_lines(args.products)
     args.products.close()
+    products, manufacturers = read_products_data(products_data)
+    if profile is not None:
+        profile.record_phase('read_products', start)
+        start = time.time()
+
+    index = prepare_catalog(products_data, manufacturers, args.cache,
+                            rebuild=args.rebuild_cache, verbose=args.verbose)
+    if profile is not None:
+        profile.record_phase('prepare', start)
+        start = time.time()
+    if args.analyze_regexes:
+        write_regex_report(manufacturers)
+    if args.rebuild_cache:
+        return
+    index.time_limit = args.time_limit
+
+    if args.previous_results:
+        old_products, old_manufacturers = read_products_data(read_lines(args.previous_products))
+        args.previous_products.close()
+        changed = changed_manufacturers(old_products, products)
+        if args.verbose:
+            sys.stderr.write('Manufacturers with changed products: {0}\n'.format(
+                ', '.join(sorted(changed)).encode('utf8') or 'none'))
+
+        previous_listings = read_previous_listings(args.previous_results, args.previous_unmatched)
+        unmatched = rematch_incremental(previous_listings, old_manufacturers, products, manufacturers,
+                                        changed, verbose=args.verbose, index=index, profile=profile)
+        args.previous_results.close()
+        args.previous_unmatched.close()
+        if profile is not None:
+            profile.record_phase('match', start)
+            start = time.time()
+
+        write_results(args.results, products, args.suppress_empty, workers=args.workers)
+        if args.unmatched:
+            write_unmatched(args.unmatched, unmatched)
+    else:
+        # Matched listings are recorded by their location in the listings
+        # file, and read back from it for the results. Listings arriving on a
+        # pipe (or gzipped) are copied to a temporary file (named, for the
+        # workers) so that they can be read back. The workers open the
+        # listings file by name, so it is copied for them too if it can't be
+        # opened again (such as stdin redirected from a file).
+        listings_source = open_input(args.listings)
+        if is_mapped(listings_source) and \
+                (args.workers == 1 or args.pipeline or is_reopenable_file(args.listings)):
+            spool = None
+            listings_filename = args.listings.name
+        else:
+            spool = tempfile.NamedTemporaryFile()
+            listings_filename = spool.name
+
+        if args.pipeline:
+            match_listings_pipeline(listings_source, products, manufacturers, args.workers,
+                                    args.pipeline, spool, verbose=args.verbose, index=index,
+                                    unmatched_file=args.unmatched, profile=profile)
+        elif args.workers > 1:
+            # The workers read their chunks of the listings file by name, so
+            # the listings must all be there first
+            if spool:
+                for offset, block in iter_blocks(listings_source):
+                    spool.write(block)
+                spool.flush()
+            match_listings_parallel(listings_filename, products, manufacturers, args.workers,
+                                    verbose=args.verbose, index=index,
+                                    unmatched_file=args.unmatched, profile=profile)
+        elif args.stream:
+            listings = iter_listings_data(listings_source, spool)
+            match_listings_stream(listings, manufacturers, verbose=args.verbose, index=index,
+                                  unmatched_file=args.unmatched, profile=profile)
+        else:
+            listings = read_listings_data(listings_source, spool)
+            unknown_manufacturer, unknown_model = match_listings_to_products(listings, manufacturers, verbose=args.verbose, index=index, profile=profile, engine=args.engine)
+        if profile is not None:
+            profile.record_phase('match', start)
+            start = time.time()
+
+        if spool:
+            spool.flush()
+            source = map_file(spool)
+        else:
+            source = listings_source
 
-    listings = read_listings_data(args.listings)
-    args.listings.close()
+        write_results(args.results, products, args.suppress_empty, source, args.workers)
+        if args.unmatched and not (args.workers > 1 or args.stream or args.pipeline):
+            # (in the order they were read)
+            unmatched = heapq.merge(((L.offset, L) for L in unknown_manufacturer),
+                                    ((L.offset, L) for L in unknown_model))
+            write_unmatched(args.unmatched, (L for (offset, L) in unmatched), source)
 
-    unknown_manufacturer, unknown_model = match_listings_to_products(listings, manufacturers, verbose=args.verbose)
+        source.close()
+        if spool:
+            spool.close()
+            if is_mapped(listings_source):
+                listings_source.close()
+        args.listings.close()
 
-    write_results(args.results, products, args.suppress_empty)
+    write_capped_listings(index)
 
+    if profile is not None:
+        profile.record_phase('write_results', start)
+        json.dump(profile.to_data(), args.profile, indent=2, sort_keys=True)
+        args.profile.write('\n')
+        args.profile.close()
+        profile.write_report(sys.stderr, args.profile_top)
 
 
 if __name__=='__main__':
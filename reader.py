@@ -0,0 +1,211 @@
+# -*- coding: utf8 -*-
+
+# Reads the lines of the input files in large blocks: regular files are
+# memory-mapped, and anything else (stdin, a pipe, a gzipped file) is read
+# through a buffered `BlockReader`. Either way, lines are handed out with
+# their byte offsets (within the uncompressed data), and a mapped file can be
+# split into chunks of whole lines for workers to read independently.
+
+import mmap
+import os
+import stat
+import zlib
+
+
+# The number of bytes read (or sliced from a mapped file) at a time
+BLOCK_SIZE = 1 << 20
+
+# The first bytes of a gzip file
+GZIP_MAGIC = '\x1f\x8b'
+
+
+class BlockReader(object):
+    '''Reads a file object that can't be mapped (such as stdin, a pipe or a
+    gzipped file) a block at a time, decompressing it if it is gzipped.
+    Blocks are returned as they become available, so lines arriving on a pipe
+    are processed promptly.'''
+    def __init__(self, f, block_size=BLOCK_SIZE):
+        self.file = f
+        self.block_size = block_size
+        try:
+            self._fileno = f.fileno()
+        except (AttributeError, ValueError):
+            self._fileno = None
+        self._decompressor = None
+        self._partial = ''
+        self._eof = False
+        self._first = True
+
+    def _read_raw(self):
+        if self._fileno is not None:
+            # (os.read returns whatever is available, rather than waiting for
+            # a whole block)
+            return os.read(self._fileno, self.block_size)
+        return self.file.read(self.block_size)
+
+    def _read(self):
+        '''Returns the next piece of (uncompressed) data, or '' at the end of
+        the file.'''
+        while True:
+            data = self._read_raw()
+            if self._first:
+                self._first = False
+                while data and len(data) < len(GZIP_MAGIC):
+                    more = self._read_raw()
+                    if not more:
+                        break
+                    data += more
+                if data.startswith(GZIP_MAGIC):
+                    self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            if self._decompressor is None:
+                return data
+            if not data:
+                return self._decompressor.flush()
+            output = []
+            while data:
+                output.append(self._decompressor.decompress(data))
+                # A gzip file may consist of several members, one after
+                # another
+                data = self._decompressor.unused_data
+                if data:
+                    self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            output = ''.join(output)
+            # (otherwise, keep reading until there is some output)
+            if output:
+                return output
+
+    def read_block(self):
+        '''Returns the next block of whole lines (the last line of the file
+        may lack its newline), or '' at the end of the file.'''
+        while not self._eof:
+            data = self._read()
+            if not data:
+                self._eof = True
+                break
+            end = data.rfind('\n') + 1
+            if end:
+                block = self._partial + data[:end]
+                self._partial = data[end:]
+                return block
+            self._partial += data
+        block = self._partial
+        self._partial = ''
+        return block
+
+
+def open_input(f):
+    '''Returns a source from which to read the lines of the file object `f`:
+    a read-only mmap if it is a regular, uncompressed file, and otherwise a
+    `BlockReader`.'''
+    try:
+        regular = stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+    except (AttributeError, ValueError, OSError):
+        regular = False
+    if regular:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # (an empty file can't be mapped)
+            pass
+        else:
+            if mapped[:len(GZIP_MAGIC)] != GZIP_MAGIC:
+                return mapped
+            mapped.close()
+    return BlockReader(f)
+
+
+def is_mapped(source):
+    '''Returns True if `source` (as returned by `open_input`) is a mapped
+    file, whose lines can be read back by their offsets.'''
+    return isinstance(source, mmap.mmap)
+
+
+def iter_blocks(source, begin=0, end=None, block_size=BLOCK_SIZE):
+    '''Yields an (offset, block) tuple for each block of whole lines read
+    from `source` (a mapped file, `BlockReader` or file object). For a mapped
+    file, only the lines starting within the byte range from `begin` to `end`
+    are read (see `split_chunks`).'''
+    if not is_mapped(source):
+        if not isinstance(source, BlockReader):
+            source = BlockReader(source, block_size)
+        offset = 0
+        for block in iter(source.read_block, ''):
+            yield offset, block
+            offset += len(block)
+        return
+
+    if end is None:
+        end = len(source)
+    offset = begin
+    while offset < end:
+        block_end = offset + block_size
+        if block_end < end:
+            # Finish the block at the end of a line
+            newline = source.rfind('\n', offset, block_end)
+            if newline < 0:
+                newline = source.find('\n', block_end, end)
+            block_end = newline + 1 if newline >= 0 else end
+        else:
+            block_end = end
+        yield offset, source[offset:block_end]
+        offset = block_end
+
+
+def block_lines(offset, block):
+    '''Yields an (offset, line) tuple for each line of a block read at
+    `offset`. The lines do not include their newlines.'''
+    lines = block.split('\n')
+    if not lines[-1]:
+        # (the block ended with a newline)
+        lines.pop()
+    for line in lines:
+        yield offset, line
+        offset += len(line) + 1
+
+
+def iter_lines(source, begin=0, end=None):
+    '''Yields an (offset, line) tuple for each line read from `source` (see
+    `iter_blocks` and `block_lines`).'''
+    for offset, block in iter_blocks(source, begin, end):
+        for item in block_lines(offset, block):
+            yield item
+
+
+def read_lines(f):
+    '''Reads all of the lines of the file object `f` (which may be gzipped),
+    and returns them as a list of strings including their newlines, like
+    `readlines`.'''
+    source = open_input(f)
+    try:
+        lines = []
+        for offset, block in iter_blocks(source):
+            pieces = block.split('\n')
+            lines += [line + '\n' for line in pieces[:-1]]
+            if pieces[-1]:
+                # (the last line of the file, lacking a newline)
+                lines.append(pieces[-1])
+        return lines
+    finally:
+        if is_mapped(source):
+            source.close()
+
+
+def split_chunks(source, count):
+    '''Splits the mapped file `source` into (at most) `count` byte ranges of
+    roughly equal size, aligned to line boundaries. Returns a list of
+    (begin, end) tuples.'''
+    size = len(source)
+    bounds = [0]
+    for i in range(1, count):
+        pos = size * i // count
+        if pos <= bounds[-1]:
+            continue
+        # Advance to the start of the next line (pos is already the start of
+        # a line if the preceding character is a newline)
+        newline = source.find('\n', pos - 1)
+        pos = newline + 1 if newline >= 0 else size
+        if bounds[-1] < pos < size:
+            bounds.append(pos)
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# A long-running server that keeps the products prepared for matching, and
+# matches listings sent to it over HTTP (on a TCP port or a Unix socket).
+
+from match import read_products_data, prepare_catalog, \
+    find_manufacturers_for_listing, find_best_match, positive_float, DEFAULT_PRODUCTS_FILE
+from classes import Listing, Deadline
+from BaseHTTPServer import BaseHTTPRequestHandler
+import SocketServer
+import argparse
+import json
+import os
+import stat
+import sys
+import threading
+import traceback
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+
+
+class Catalog(object):
+    '''The products and manufacturers read from a products file, prepared for
+    matching.'''
+    def __init__(self, products_filename, cache_filename=None, verbose=False, time_limit=None):
+        with open(products_filename, 'rb') as products_file:
+            products_data = products_file.readlines()
+        self.products_filename = products_filename
+        self.products, self.manufacturers = read_products_data(products_data)
+        self.index = prepare_catalog(products_data, self.manufacturers,
+                                     cache_filename, verbose=verbose)
+        self.index.time_limit = time_limit
+
+    def match(self, listing):
+        '''Returns a `ProductMatch` for the product that best matches
+        `listing`, or None if there is no match. If the catalog has a time
+        limit, the best match found within it is returned, and listings cut
+        short by it are reported on stderr. (Each call has its own `Deadline`,
+        as requests are handled in separate threads.)'''
+        manufacturers_to_search = find_manufacturers_for_listing(
+            listing, self.manufacturers, self.index)
+        if not manufacturers_to_search:
+            return None
+        if self.index.time_limit is None:
+            return find_best_match(listing, manufacturers_to_search, self.index)
+        deadline = Deadline(self.index.time_limit)
+        best_match = find_best_match(listing, manufacturers_to_search, self.index, deadline=deadline)
+        if deadline.skipped:
+            sys.stderr.write(u'Listing cut short by the time limit for matching: {0}: {1}\n'.format(
+                listing.manufacturer, listing.searchable_title).encode('utf8'))
+        return best_match
+
+
+def match_result_json(catalog, jsonstring):
+    '''Matches the listing given by `jsonstring`, and returns a JSON string
+    giving the matched product_name (null if there is no match), and the
+    `begin` and `length` of the match within the listing's searchable
+    title.'''
+    listing = Listing(jsonstring)
+    best_match = catalog.match(listing)
+    if best_match:
+        result = {
+            'product_name': best_match.product.product_name,
+            'begin': best_match.begin,
+            'length': best_match.length,
+        }
+    else:
+        result = {'product_name': None}
+    return json.dumps(result)
+
+
+class MatchRequestHandler(BaseHTTPRequestHandler):
+    '''Handles requests to the match server:
+
+    POST /match  -- the body contains one or more listing JSON objects, one
+                    per line (as in a listings file); the response contains a
+                    JSON object for each, one per line, giving the match
+    POST /reload -- re-reads the products file, and swaps it in once it is
+                    ready; if the server was started with
+                    --allow-reload-path, the body may be a JSON object with a
+                    "products" filename to read instead
+    '''
+
+    # Keep connections open between requests
+    protocol_version = 'HTTP/1.1'
+    # Buffer each response, so that it is sent with a single write (otherwise
+    # Nagle's algorithm delays the response by tens of milliseconds)
+    wbufsize = -1
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length)
+
+        try:
+            if self.path == '/match':
+                # Use the same catalog for the whole request, even if a reload
+                # happens part-way through
+                catalog = self.server.catalog
+                output = [match_result_json(catalog, lj) for lj in body.splitlines() if lj.strip()]
+                self.send_output(200, '\n'.join(output) + '\n')
+            elif self.path == '/reload':
+                products_filename = None
+                if body.strip():
+                    products_filename = json.loads(body).get('products')
+                if products_filename is not None and not self.server.allow_reload_path:
+                    self.send_output(403, json.dumps({
+                        'error': 'reloading from another products file is not allowed'
+                    }) + '\n')
+                    return
+                self.server.reload(products_filename)
+                self.send_output(200, json.dumps({
+                    'products': self.server.catalog.products_filename,
+                    'count': len(self.server.catalog.products),
+                }) + '\n')
+            else:
+                self.send_output(404, json.dumps({'error': 'not found'}) + '\n')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.send_output(400, json.dumps({'error': 'bad request: ' + str(e)}) + '\n')
+        except IOError as e:
+            self.send_output(500, json.dumps({'error': str(e)}) + '\n')
+
+    def send_output(self, code, output):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def address_string(self):
+        # (the client address is empty for Unix sockets)
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return self.server.server_address
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def is_socket(filename):
+    '''Returns True if `filename` exists and is a Unix socket.'''
+    try:
+        return stat.S_ISSOCK(os.lstat(filename).st_mode)
+    except OSError:
+        return False
+
+
+class MatchServerMixin:
+    '''Holds the current `Catalog` for the match server, and swaps in a new
+    one on reload.'''
+    daemon_threads = True
+
+    def setup_catalog(self, products_filename, cache_filename=None, verbose=False, time_limit=None,
+                      allow_reload_path=False):
+        self.cache_filename = cache_filename
+        self.allow_reload_path = allow_reload_path
+        self.verbose = verbose
+        self.time_limit = time_limit
+        self._reload_lock = threading.Lock()
+        self.catalog = Catalog(products_filename, cache_filename, verbose, time_limit)
+
+    def reload(self, products_filename=None):
+        '''Prepares a new catalog from the products file, then replaces the
+        current one with it. Requests already being handled carry on with the
+        old catalog.'''
+        with self._reload_lock:
+            if products_filename is None:
+                products_filename = self.catalog.products_filename
+            catalog = Catalog(products_filename, self.cache_filename, self.verbose, self.time_limit)
+            self.catalog = catalog
+
+
+class TCPMatchServer(MatchServerMixin, SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+
+
+class UnixMatchServer(MatchServerMixin, SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    pass
+
+
+def parse_my_arguments(arguments=None):
+    '''Processes the arguments to the command using argparse and returns the
+    resulting object.'''
+
+    parser = argparse.ArgumentParser(
+        description='''Keeps the products prepared for matching, and matches
+                       listings sent over HTTP. POST listings (one JSON object
+                       per line) to /match to get the matched product_name
+                       for each, and POST to /reload to reload the products
+                       file.'''
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        help='increase output verbosity'
+    )
+    parser.add_argument(
+        '-p', '--products',
+        metavar='PRODUCTS_FILE',
+        default=DEFAULT_PRODUCTS_FILE,
+        help='file containing JSON objects (one per line) describing the products'
+    )
+    parser.add_argument(
+        '-c', '--cache',
+        metavar='CACHE_FILE',
+        help='''cache the products, prepared for matching, in this file (see
+                match.py)'''
+    )
+    parser.add_argument(
+        '--time-limit',
+        type=positive_float, metavar='SECONDS',
+        help='''stop matching a listing once this many seconds have been
+                spent on it, and use the best match found by then (see
+                match.py)'''
+    )
+    parser.add_argument(
+        '--allow-reload-path',
+        action='store_true',
+        help='''let POSTs to /reload name a different products file to read
+                (by default, only PRODUCTS_FILE is reloaded)'''
+    )
+    parser.add_argument(
+        '--host',
+        default=DEFAULT_HOST,
+        help='address to listen on (default is {0})'.format(DEFAULT_HOST)
+    )
+    parser.add_argument(
+        '--port',
+        type=int, default=DEFAULT_PORT,
+        help='port to listen on (default is {0})'.format(DEFAULT_PORT)
+    )
+    parser.add_argument(
+        '-s', '--socket',
+        metavar='SOCKET_FILE',
+        help='listen on this Unix socket instead of a TCP port'
+    )
+
+    if arguments is not None:
+        if isinstance(arguments, list):
+            args = parser.parse_args(arguments)
+        elif isinstance(arguments, str):
+            args = parser.parse_args(arguments.split())
+        else:
+            raise TypeError("'arguments' must be either a string or a list of strings")
+    else:
+        args = parser.parse_args()
+
+    # (a stale socket is replaced, but nothing else is)
+    if args.socket and os.path.lexists(args.socket) and not is_socket(args.socket):
+        parser.error('{0} exists and is not a socket'.format(args.socket))
+
+    return args
+
+
+def main(arguments=None):
+    args = parse_my_arguments(arguments)
+
+    if args.socket:
+        if is_socket(args.socket):
+            os.unlink(args.socket)
+        server = UnixMatchServer(args.socket, MatchRequestHandler, bind_and_activate=False)
+    else:
+        server = TCPMatchServer((args.host, args.port), MatchRequestHandler, bind_and_activate=False)
+
+    # Prepare the products before accepting any connections
+    server.setup_catalog(args.products, args.cache, args.verbose, args.time_limit,
+                         args.allow_reload_path)
+    server.server_bind()
+    server.server_activate()
+
+    if args.verbose:
+        sys.stderr.write('Listening on {0}\n'.format(args.socket or '{0}:{1}'.format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if args.socket and is_socket(args.socket):
+            os.unlink(args.socket)
+
+
+
+if __name__=='__main__':
+    try:
+        main()
+        sys.exit(0)
+    except KeyboardInterrupt as e:
+        raise e
+    except SystemExit as e:
+        raise e
+    except argparse.ArgumentError as e:
+        print str(e)
+    except Exception as e:
+        print str(e)
+        traceback.print_exc()
+        sys.exit(1)
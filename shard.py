@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# Matches listings against a product catalog that is split by manufacturer
+# into shards, each prepared and matched by its own process (or machine), with
+# the shards' matches merged at the end. The steps exchange plain files in a
+# shard directory, so they can be run separately:
+#
+#   shard.py split -n N -d DIR        partition the products into N shards
+#   shard.py route -d DIR             send each listing to the shards of the
+#                                     manufacturers it is searched against
+#   shard.py match -d DIR -s K        match the listings routed to shard K
+#   shard.py merge -d DIR             pick each listing's best match, and
+#                                     write the results
+#
+# or all together, with a process per shard, with `shard.py run -n N`.
+
+from match import read_products_data, prepare_manufacturers, \
+    find_manufacturers_for_listing, find_best_match, write_results, \
+    write_unmatched, map_file, products_digest, is_regular_file, OutputFileType, \
+    DEFAULT_PRODUCTS_FILE, DEFAULT_LISTINGS_FILE, DEFAULT_RESULTS_FILE
+from classes import Listing
+from reader import open_input, is_mapped, iter_blocks, block_lines, iter_lines
+import argparse
+import json
+import os
+import subprocess
+import sys
+import traceback
+
+DEFAULT_SHARD_DIR = 'shards'
+
+# Names of the files in the shard directory
+MANIFEST_FILE = 'manifest.json'
+# A copy of listings that can't be mapped (read from a pipe, or gzipped), so
+# that the merge step can read them back by their offsets
+LISTINGS_COPY_FILE = 'listings.txt'
+
+
+class ManifestError(ValueError):
+    '''Raised when the shard directory doesn't belong to the given
+    products.'''
+
+
+def shard_filename(shard_dir, kind, shard):
+    '''Returns the name of the given kind of file ("products", "routed" or
+    "matches") for a shard.'''
+    return os.path.join(shard_dir, '{0}-{1}.txt'.format(kind, shard))
+
+
+def parse_my_arguments(arguments=None):
+    '''Processes the arguments to the command using argparse and returns the
+    resulting object.'''
+
+    parser = argparse.ArgumentParser(
+        description='''Matches listings to products with the products split by
+                       manufacturer into shards, each matched by its own
+                       process. The steps communicate through files in
+                       SHARD_DIR, so they can be run separately (on different
+                       machines, for instance), or all at once with "run".
+                       The results are the same as those of match.py.'''
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        help='increase output verbosity'
+    )
+    parser.add_argument(
+        '-d', '--shard-dir',
+        metavar='SHARD_DIR', default=DEFAULT_SHARD_DIR,
+        help='directory for the files exchanged between the steps (default is "{0}")'.format(DEFAULT_SHARD_DIR)
+    )
+    subparsers = parser.add_subparsers(dest='command')
+
+    def add_products_argument(subparser):
+        subparser.add_argument(
+            '-p', '--products',
+            type=argparse.FileType('r'), metavar='PRODUCTS_FILE',
+            default=DEFAULT_PRODUCTS_FILE,
+            help='file containing JSON objects (one per line) describing the products'
+        )
+
+    def add_listings_argument(subparser):
+        subparser.add_argument(
+            '-l', '--listings',
+            type=argparse.FileType('r'), metavar='LISTINGS_FILE',
+            default=DEFAULT_LISTINGS_FILE,
+            help='file containing JSON objects (one per line) containing the listings'
+        )
+
+    def add_output_arguments(subparser):
+        subparser.add_argument(
+            '-r', '--results',
+            type=OutputFileType(), metavar='RESULTS_FILE',
+            default=DEFAULT_RESULTS_FILE,
+            help='write results to this file (as match.py does)'
+        )
+        subparser.add_argument(
+            '-u', '--unmatched',
+            type=OutputFileType(), metavar='UNMATCHED_FILE',
+            help='write listings that could not be matched to this file'
+        )
+        subparser.add_argument(
+            '--suppress-empty',
+            action='store_true',
+            help='''in results file, do not include results objects for
+                    products that have no matched listings'''
+        )
+
+    def add_shards_argument(subparser):
+        subparser.add_argument(
+            '-n', '--shards',
+            type=int, metavar='N', required=True,
+            help='number of shards to split the products into'
+        )
+
+    split_parser = subparsers.add_parser(
+        'split', help='split the products by manufacturer into shards')
+    add_products_argument(split_parser)
+    add_shards_argument(split_parser)
+
+    route_parser = subparsers.add_parser(
+        'route', help='''write each listing to the shards holding the
+                         manufacturers it should be searched against''')
+    add_products_argument(route_parser)
+    add_listings_argument(route_parser)
+
+    match_parser = subparsers.add_parser(
+        'match', help='match the listings routed to a shard')
+    match_parser.add_argument(
+        '-s', '--shard',
+        type=int, metavar='K', required=True,
+        help='the shard to match (numbered from 0)'
+    )
+
+    merge_parser = subparsers.add_parser(
+        'merge', help='''merge the matches from every shard, and write the
+                         results''')
+    add_products_argument(merge_parser)
+    add_listings_argument(merge_parser)
+    add_output_arguments(merge_parser)
+
+    run_parser = subparsers.add_parser(
+        'run', help='''split, route, match each shard in its own process, and
+                       merge''')
+    add_products_argument(run_parser)
+    add_listings_argument(run_parser)
+    add_shards_argument(run_parser)
+    add_output_arguments(run_parser)
+
+    if arguments is not None:
+        if isinstance(arguments, list):
+            args = parser.parse_args(arguments)
+        elif isinstance(arguments, str):
+            args = parser.parse_args(arguments.split())
+        else:
+            raise TypeError("'arguments' must be either a string or a list of strings")
+    else:
+        args = parser.parse_args()
+
+    if getattr(args, 'shards', 1) < 1:
+        parser.error('the number of shards must be at least 1')
+
+    # The output files are opened without truncating them (see main), so that
+    # they can first be checked against the input files, as match.py does
+    inputs = [f for f in (getattr(args, 'products', None), getattr(args, 'listings', None))
+              if f and is_regular_file(f)]
+    for output in (getattr(args, 'results', None), getattr(args, 'unmatched', None)):
+        if output and is_regular_file(output):
+            for f in inputs:
+                if os.path.sameopenfile(f.fileno(), output.fileno()):
+                    parser.error('{0} is both an input and an output file'.format(output.name))
+
+    return args
+
+
+def split_catalog(products_data, shards, shard_dir):
+    '''Partitions the manufacturers of the products (given as a list of JSON
+    strings) into `shards` groups with similar numbers of products, and writes
+    each group's products (in their original order) to its products file in
+    `shard_dir`, along with a manifest giving the shard of each manufacturer
+    and a digest of the products (see `read_manifest`). Returns the
+    manifest.'''
+    products, manufacturers = read_products_data(products_data)
+
+    # Largest manufacturers first, each to the shard with the fewest products
+    # so far
+    sizes = [0] * shards
+    assignment = {}
+    for M in sorted(manufacturers.itervalues(), key=lambda M: (-len(M.products), M.name)):
+        shard = min(range(shards), key=lambda k: sizes[k])
+        assignment[M.name] = shard
+        sizes[shard] += len(M.products)
+
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    shard_files = [open(shard_filename(shard_dir, 'products', k), 'wb') for k in range(shards)]
+    for P, pj in zip(products, products_data):
+        shard_files[assignment[P.manufacturer]].write(pj.rstrip('\r\n') + '\n')
+    for f in shard_files:
+        f.close()
+
+    manifest = {'shards': shards, 'manufacturers': assignment,
+                'products_digest': products_digest(products_data)}
+    with open(os.path.join(shard_dir, MANIFEST_FILE), 'wb') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    return manifest
+
+
+def read_manifest(shard_dir, products_data=None):
+    '''Returns the manifest written by `split_catalog` to `shard_dir`. If
+    `products_data` is given, raises ManifestError unless the shards were split
+    from those products (with the same matching rules), since routing or
+    merging with a different catalog would silently give wrong results.'''
+    with open(os.path.join(shard_dir, MANIFEST_FILE), 'rb') as manifest_file:
+        manifest = json.load(manifest_file)
+    if products_data is not None and manifest.get('products_digest') != products_digest(products_data):
+        raise ManifestError('the shards in {0} were split from a different products file (or '
+                            'matching rules); run "shard.py split" again'.format(shard_dir))
+    return manifest
+
+
+def route_listings(listings_file, products_data, shard_dir, verbose=False, manufacturers=None,
+                   index=None):
+    '''Finds the manufacturers for each listing (as `match.py` would, using
+    the whole catalog) and writes the listing to the routed file of each shard
+    holding one of them. Each line of a routed file is a JSON array giving the
+    listing's byte offset and length within the listings file and the names of
+    its manufacturers (in the order they are searched), then a tab, then the
+    listing's JSON string. Listings with no manufacturers are not routed.
+
+    If the listings file can't be mapped (it is a pipe, or gzipped), the
+    listings read are copied to the shard directory, and the offsets refer to
+    that copy (see `open_routed_listings`).
+
+    The manufacturers are found with a `CatalogIndex` of the whole catalog,
+    which is prepared here unless `manufacturers` and their `index` are
+    given.'''
+    manifest = read_manifest(shard_dir, products_data)
+    assignment = manifest['manufacturers']
+    if index is None:
+        products, manufacturers = read_products_data(products_data)
+        index = prepare_manufacturers(manufacturers, verbose=verbose)
+
+    shard_files = [open(shard_filename(shard_dir, 'routed', k), 'wb')
+                   for k in range(manifest['shards'])]
+    routed = [0] * len(shard_files)
+    source = open_input(listings_file)
+    copy_filename = os.path.join(shard_dir, LISTINGS_COPY_FILE)
+    if is_mapped(source):
+        copy = None
+        # (so that a copy left by routing other listings isn't read instead)
+        if os.path.exists(copy_filename):
+            os.remove(copy_filename)
+    else:
+        copy = open(copy_filename, 'wb')
+    for offset, block in iter_blocks(source):
+        if copy is not None:
+            copy.write(block)
+        for offset, lj in block_lines(offset, block):
+            L = Listing(lj, offset)
+            manufacturers_to_search = find_manufacturers_for_listing(L, manufacturers, index)
+            if not manufacturers_to_search:
+                continue
+            names = [M.name for M in manufacturers_to_search]
+            head = json.dumps([L.offset, L.length, names])
+            for shard in sorted(set(assignment[name] for name in names)):
+                shard_files[shard].write(head + '\t' + lj.strip() + '\n')
+                routed[shard] += 1
+    if is_mapped(source):
+        source.close()
+    if copy is not None:
+        copy.close()
+    for f in shard_files:
+        f.close()
+
+    if verbose:
+        for shard, count in enumerate(routed):
+            sys.stderr.write('Routed {0} listings to shard {1}\n'.format(count, shard))
+
+
+def match_shard(shard_dir, shard, verbose=False):
+    '''Matches the listings routed to a shard against the shard's products,
+    searching only the manufacturers each listing was routed for that belong
+    to this shard. Writes a line to the shard's matches file for each listing
+    that matches: a JSON array of the listing's offset and length, the
+    matched product_name, the begin and length of the match, and the position
+    of the product's manufacturer among the listing's manufacturers.'''
+    with open(shard_filename(shard_dir, 'products', shard), 'rb') as products_file:
+        products, manufacturers = read_products_data(products_file)
+    index = prepare_manufacturers(manufacturers, verbose=verbose)
+
+    matched = 0
+    with open(shard_filename(shard_dir, 'routed', shard), 'rb') as routed_file, \
+            open(shard_filename(shard_dir, 'matches', shard), 'wb') as matches_file:
+        for line in routed_file:
+            head, lj = line.split('\t', 1)
+            offset, length, names = json.loads(head)
+            L = Listing(lj, keep_data=False)
+            manufacturers_to_search = [manufacturers[name] for name in names if name in manufacturers]
+            best_match = find_best_match(L, manufacturers_to_search, index)
+            if best_match:
+                matches_file.write(json.dumps([
+                    offset, length, best_match.product.product_name,
+                    best_match.begin, best_match.length,
+                    names.index(best_match.product.manufacturer),
+                ]) + '\n')
+                matched += 1
+
+    if verbose:
+        sys.stderr.write('Shard {0} matched {1} listings\n'.format(shard, matched))
+
+
+def merge_matches(shard_dir):
+    '''Reads the matches files of all the shards, and returns a dict mapping
+    each matched listing's (offset, length) to its best match, as a
+    (product_name, begin, length, manufacturer position) tuple. A listing
+    matched by several shards is given the match that `find_best_match`
+    would have chosen: the one that starts earliest, then the longest, then
+    the one from the manufacturer that was searched first.'''
+    manifest = read_manifest(shard_dir)
+    best = {}
+    for shard in range(manifest['shards']):
+        with open(shard_filename(shard_dir, 'matches', shard), 'rb') as matches_file:
+            for line in matches_file:
+                offset, length, product_name, begin, match_length, position = json.loads(line)
+                key = (offset, length)
+                match = (product_name, begin, match_length, position)
+                current = best.get(key)
+                if current is None or (begin, -match_length, position) < (current[1], -current[2], current[3]):
+                    best[key] = match
+    return best
+
+
+def open_routed_listings(listings_file, shard_dir):
+    '''Returns a mapped file (or, if it is empty, a file object) to read the
+    routed listings back from by their offsets: the listings file itself if
+    it can be mapped, or otherwise the copy of it made by `route_listings`.'''
+    source = open_input(listings_file)
+    if is_mapped(source):
+        return source
+    try:
+        copy = open(os.path.join(shard_dir, LISTINGS_COPY_FILE), 'rb')
+    except IOError:
+        raise IOError('{0} is a pipe or gzipped, and no copy of it was made '
+                      'when the listings were routed to {1}'.format(listings_file.name, shard_dir))
+    return map_file(copy)
+
+
+def write_merged_results(products_data, listings_file, shard_dir, results_file,
+                         unmatched_file=None, suppress_empty=False):
+    '''Writes the merged matches of the shards as a results file (and,
+    optionally, the unmatched listings), in the same form and order as
+    `match.py`. The listings are read back as `open_routed_listings`
+    describes.'''
+    read_manifest(shard_dir, products_data)
+    products, manufacturers = read_products_data(products_data)
+    products_by_name = dict((P.product_name, P) for P in products)
+    best = merge_matches(shard_dir)
+
+    # Associate the listings with their products in the order they appear in
+    # the listings file, as match.py does
+    for (offset, length) in sorted(best):
+        products_by_name[best[(offset, length)][0]].associate_listing_span(offset, length)
+
+    source = open_routed_listings(listings_file, shard_dir)
+    write_results(results_file, products, suppress_empty, source)
+    if unmatched_file:
+        unmatched = []
+        for offset, lj in iter_lines(source):
+            data = lj.strip()
+            key = (offset + lj.find(data), len(data))
+            if key not in best:
+                unmatched.append(Listing.from_fields(key[0], key[1], None, None))
+        write_unmatched(unmatched_file, unmatched, source)
+    source.close()
+
+
+def run_shards(shard_dir, shards, verbose=False):
+    '''Matches each of the shards in its own process (running
+    `shard.py match`), and waits for them all to finish.'''
+    command = [sys.executable, os.path.abspath(__file__), '-d', shard_dir]
+    if verbose:
+        command.append('-v')
+    processes = [subprocess.Popen(command + ['match', '-s', str(k)]) for k in range(shards)]
+    failed = [k for (k, process) in enumerate(processes) if process.wait() != 0]
+    if failed:
+        raise RuntimeError('matching failed for shard(s) {0}'.format(', '.join(map(str, failed))))
+
+
+def main(arguments=None):
+    args = parse_my_arguments(arguments)
+
+    products_data = None
+    if getattr(args, 'products', None):
+        products_data = args.products.readlines()
+        args.products.close()
+
+    if args.command in ('split', 'run'):
+        split_catalog(products_data, args.shards, args.shard_dir)
+    if args.command in ('route', 'run'):
+        route_listings(args.listings, products_data, args.shard_dir, verbose=args.verbose)
+    if args.command == 'match':
+        match_shard(args.shard_dir, args.shard, verbose=args.verbose)
+    if args.command == 'run':
+        run_shards(args.shard_dir, args.shards, verbose=args.verbose)
+    if args.command in ('merge', 'run'):
+        for output in (args.results, args.unmatched):
+            if output and output is not sys.stdout:
+                output.truncate(0)
+        write_merged_results(products_data, args.listings, args.shard_dir, args.results,
+                             args.unmatched, args.suppress_empty)
+        args.results.close()
+        if args.unmatched:
+            args.unmatched.close()
+
+    if getattr(args, 'listings', None):
+        args.listings.close()
+
+
+
+if __name__=='__main__':
+    try:
+        main()
+        sys.exit(0)
+    except KeyboardInterrupt as e:
+        raise e
+    except SystemExit as e:
+        raise e
+    except argparse.ArgumentError as e:
+        print str(e)
+    except ManifestError as e:
+        sys.exit(str(e))
+    except Exception as e:
+        print str(e)
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,533 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# Tests of match.py (and the tools built on it), mostly run as a command on a
+# slice of the sample data, checking that each way of matching gives the same
+# output as a default run. Run with `python -m unittest test_match`.
+
+import gzip
+import httplib
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from classes import Deadline, Listing, TitleBlob, searchable_title, searchable_titles
+from match import read_products_data, prepare_manufacturers, match_listing, read_lines, \
+    find_manufacturers_for_listing, find_best_match, parse_results_line, \
+    top_matches_for_listings
+from server import UnixMatchServer, MatchRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MATCH = os.path.join(HERE, 'match.py')
+SHARD = os.path.join(HERE, 'shard.py')
+COMPARE = os.path.join(HERE, 'compare.py')
+SERVER = os.path.join(HERE, 'server.py')
+PRODUCTS_FILE = os.path.join(HERE, 'data', 'products.txt')
+SAMPLE_LISTINGS_FILE = os.path.join(HERE, 'data', 'listings.txt')
+
+# The number of sample listings matched by each test
+LISTINGS_COUNT = 1000
+
+# Every this many products is left out of the products file of the "previous"
+# run in the incremental mode tests
+PREVIOUS_PRODUCTS_GAP = 7
+
+
+def results_by_product(results):
+    '''Returns a dict of the sorted listings JSON strings of each product in
+    the results, so that results can be compared regardless of the order of
+    each product's listings.'''
+    by_product = {}
+    for line in results.splitlines():
+        product_name, listings_data = parse_results_line(line)
+        by_product[product_name] = sorted(listings_data)
+    return by_product
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    '''An HTTP connection to a server listening on a Unix socket.'''
+    def __init__(self, socket_filename):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_filename = socket_filename
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_filename)
+
+
+class MatchCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.listings = self.path('listings.txt')
+        with open(SAMPLE_LISTINGS_FILE, 'rb') as sample, open(self.listings, 'wb') as listings:
+            for n, line in enumerate(sample):
+                if n == LISTINGS_COUNT:
+                    break
+                listings.write(line)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def run_command(self, command, stdin=None, stdout=None):
+        '''Runs a command in the test directory, failing the test if it exits
+        with an error. Returns what it wrote to stderr.'''
+        process = subprocess.Popen([sys.executable] + command, stdin=stdin, stdout=stdout,
+                                   stderr=subprocess.PIPE, cwd=self.directory)
+        errors = process.communicate()[1]
+        self.assertEqual(process.returncode, 0, errors)
+        self.assertNotIn('Traceback', errors)
+        return errors
+
+    def run_match(self, arguments, stdin=None, stdout=None):
+        '''Runs match.py on the test listings (unless other listings are
+        given), failing the test if it exits with an error.'''
+        self.run_command([MATCH, '-p', PRODUCTS_FILE, '-l', self.listings] + arguments,
+                         stdin, stdout)
+
+    def run_shard(self, listings, stdin=None):
+        '''Runs shard.py with 3 shards, writing results.txt and
+        unmatched.txt.'''
+        self.run_command([SHARD, '-d', self.path('shards'), 'run', '-n', '3',
+                          '-p', PRODUCTS_FILE, '-l', listings,
+                          '-r', self.path('results.txt'), '-u', self.path('unmatched.txt')],
+                         stdin)
+
+    def run_match_error(self, arguments, listings=True):
+        '''Runs match.py (on the test listings, if `listings` is set) in the
+        test directory, and returns its exit status.'''
+        command = [sys.executable, MATCH, '-p', PRODUCTS_FILE] + arguments
+        if listings:
+            command += ['-l', self.listings]
+        with open(os.devnull, 'wb') as devnull:
+            return subprocess.call(command, stdout=devnull, stderr=devnull, cwd=self.directory)
+
+    def run_shard_error(self, arguments):
+        '''Runs shard.py in the test directory, and returns its exit status
+        and everything it printed.'''
+        process = subprocess.Popen([sys.executable, SHARD, '-d', self.path('shards')] + arguments,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   cwd=self.directory)
+        output = process.communicate()[0]
+        return process.returncode, output
+
+    def previous_run(self):
+        '''Runs match.py with some of the products left out (see
+        `write_previous_products`), writing previous.txt and
+        previous-unmatched.txt. Returns the arguments for an incremental run
+        from it.'''
+        previous_products = self.write_previous_products()
+        self.run_match(['-p', previous_products, '-r', self.path('previous.txt'),
+                        '-u', self.path('previous-unmatched.txt')])
+        return ['--previous-products', previous_products,
+                '--previous-results', self.path('previous.txt'),
+                '--previous-unmatched', self.path('previous-unmatched.txt')]
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def expected_results(self):
+        self.run_match(['-r', self.path('expected.txt')])
+        return self.read('expected.txt')
+
+    def expected_results_and_unmatched(self):
+        self.run_match(['-r', self.path('expected.txt'), '-u', self.path('expected-unmatched.txt')])
+        return self.read('expected.txt'), self.read('expected-unmatched.txt')
+
+    def expected_products(self):
+        '''Returns a dict giving the product_name that each matched listing's
+        JSON string is matched to by a default run.'''
+        products = {}
+        for product_name, listings_data in results_by_product(self.expected_results()).iteritems():
+            for lj in listings_data:
+                products[lj] = product_name
+        return products
+
+    def assertResultsAndUnmatched(self, expected):
+        self.assertEqual((self.read('results.txt'), self.read('unmatched.txt')), expected)
+
+    def assertSameAsDefault(self, arguments, stdin=None):
+        '''Checks that running match.py with the given arguments writes the
+        same results and unmatched listings as a default run.'''
+        expected = self.expected_results_and_unmatched()
+        self.run_match(arguments + ['-r', self.path('results.txt'), '-u', self.path('unmatched.txt')],
+                       stdin)
+        self.assertResultsAndUnmatched(expected)
+
+    def write_gzipped_listings(self):
+        with open(self.listings, 'rb') as listings, \
+                gzip.open(self.path('listings.txt.gz'), 'wb') as gzipped:
+            shutil.copyfileobj(listings, gzipped)
+        return self.path('listings.txt.gz')
+
+    def write_previous_products(self):
+        '''Writes the products, leaving some out, to previous-products.txt
+        for the incremental mode tests.'''
+        with open(PRODUCTS_FILE, 'rb') as products, \
+                open(self.path('previous-products.txt'), 'wb') as previous:
+            for n, line in enumerate(products):
+                if n % PREVIOUS_PRODUCTS_GAP:
+                    previous.write(line)
+        return self.path('previous-products.txt')
+
+    def test_stream(self):
+        self.assertSameAsDefault(['--stream'])
+
+    def test_stream_from_pipe(self):
+        cat = subprocess.Popen(['cat', self.listings], stdout=subprocess.PIPE)
+        self.assertSameAsDefault(['--stream', '-l', '-'], stdin=cat.stdout)
+        cat.wait()
+
+    def test_workers(self):
+        self.assertSameAsDefault(['-w', '3'])
+
+    def test_cache(self):
+        cache = self.path('cache.json')
+        self.assertSameAsDefault(['--cache', cache])
+        self.assertTrue(os.path.exists(cache))
+        # (the second run uses the cache)
+        self.assertSameAsDefault(['--cache', cache])
+
+    def test_malformed_cache_rebuilt(self):
+        cache = self.path('cache.json')
+        self.assertSameAsDefault(['--cache', cache])
+        with open(cache, 'rb') as f:
+            data = json.load(f)
+        for name in data['manufacturers']:
+            data['manufacturers'][name] = {}
+        for contents in (json.dumps(data), json.dumps(data)[:100], '[]'):
+            with open(cache, 'wb') as f:
+                f.write(contents)
+            self.assertSameAsDefault(['--cache', cache])
+
+    def test_server(self):
+        expected = self.expected_products()
+
+        socket_filename = self.path('server.sock')
+        server = UnixMatchServer(socket_filename, MatchRequestHandler)
+        server.setup_catalog(PRODUCTS_FILE)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            with open(self.listings, 'rb') as listings_file:
+                listings_data = [lj.strip() for lj in listings_file]
+            connection = UnixHTTPConnection(socket_filename)
+            connection.request('POST', '/match', '\n'.join(listings_data) + '\n')
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            matches = [json.loads(line) for line in response.read().splitlines()]
+            connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual([match['product_name'] for match in matches],
+                         [expected.get(lj) for lj in listings_data])
+
+    def test_server_socket_must_not_be_a_file(self):
+        with open(os.devnull, 'wb') as devnull:
+            status = subprocess.call([sys.executable, SERVER, '-p', PRODUCTS_FILE, '-s', self.listings],
+                                     stdout=devnull, stderr=devnull)
+        self.assertEqual(status, 2)
+        self.assertTrue(os.path.isfile(self.listings))
+
+    def test_results_to_stdout_with_workers(self):
+        expected = self.expected_results()
+        with open(self.path('out.txt'), 'wb') as out:
+            self.run_match(['-r', '-', '-w', '2'], stdout=out)
+        self.assertEqual(self.read('out.txt'), expected)
+
+    def test_listings_from_redirected_stdin_with_workers(self):
+        expected = self.expected_results()
+        with open(self.listings, 'rb') as listings:
+            self.run_match(['-l', '-', '-r', self.path('out.txt'), '-w', '2'], stdin=listings)
+        self.assertEqual(self.read('out.txt'), expected)
+
+    def test_no_workers_rejected(self):
+        for arguments in (['-w', '0'], ['--pipeline', 'thread', '-w', '0']):
+            self.assertEqual(self.run_match_error(['-r', self.path('out.txt')] + arguments), 2)
+
+    def test_incremental(self):
+        expected = self.expected_results_and_unmatched()
+        # (from the test directory, where there is no default listings file)
+        self.run_command([MATCH, '-p', PRODUCTS_FILE] + self.previous_run() +
+                         ['-r', self.path('results.txt'), '-u', self.path('unmatched.txt')])
+        # (re-matched listings come after a product's other listings, and
+        # unmatched listings are written in the order they are found)
+        self.assertEqual(results_by_product(self.read('results.txt')),
+                         results_by_product(expected[0]))
+        self.assertEqual(sorted(self.read('unmatched.txt').splitlines()),
+                         sorted(expected[1].splitlines()))
+
+    def test_incremental_requires_previous_unmatched(self):
+        self.expected_results()
+        self.assertEqual(self.run_match_error(['-r', self.path('out.txt'),
+                                               '--previous-products', PRODUCTS_FILE,
+                                               '--previous-results', self.path('expected.txt')],
+                                              listings=False), 2)
+
+    def test_incremental_rejects_unused_options(self):
+        previous = self.previous_run()
+        for arguments in (['-l', self.listings], ['--stream'], ['--pipeline', 'thread'],
+                          ['--engine', 'scan']):
+            self.assertEqual(self.run_match_error(['-r', self.path('out.txt')] + previous + arguments,
+                                                  listings=False), 2)
+
+    def test_results_appended_to_stdout(self):
+        expected = self.expected_results()
+        with open(self.path('out.txt'), 'wb') as out:
+            out.write('log\n')
+        with open(self.path('out.txt'), 'ab') as out:
+            self.run_match(['-r', '-'], stdout=out)
+        self.assertEqual(self.read('out.txt'), 'log\n' + expected)
+
+    def test_top_matches(self):
+        expected = self.expected_products()
+
+        with open(PRODUCTS_FILE, 'rb') as products_file:
+            products, manufacturers = read_products_data(read_lines(products_file))
+        with open(self.listings, 'rb') as listings_file:
+            listings = [Listing(lj) for lj in listings_file]
+        for L, matches in top_matches_for_listings(listings, manufacturers, 3):
+            self.assertLessEqual(len(matches), 3)
+            self.assertEqual(matches[0].product.product_name if matches else None,
+                             expected.get(L.orig_data.strip()))
+            ranks = [(M.begin, -M.length) for M in matches]
+            self.assertEqual(ranks, sorted(ranks))
+
+    def test_gzipped_listings(self):
+        self.assertSameAsDefault(['-l', self.write_gzipped_listings()])
+
+    def test_pipeline_threads(self):
+        self.assertSameAsDefault(['--pipeline', 'thread', '-w', '2'])
+
+    def test_pipeline_processes(self):
+        self.assertSameAsDefault(['--pipeline', 'process', '-w', '2'])
+
+    def test_engine_scan(self):
+        self.assertSameAsDefault(['--engine', 'scan'])
+
+    def test_engine_listing(self):
+        self.assertSameAsDefault(['--engine', 'listing'])
+
+    def test_time_limit_not_reached(self):
+        self.assertSameAsDefault(['--time-limit', '60'])
+
+    def test_time_limit_must_be_positive(self):
+        for limit in ('0', '-1', 'nan'):
+            self.assertEqual(self.run_match_error(['-r', self.path('out.txt'), '--time-limit', limit]), 2)
+            with open(os.devnull, 'wb') as devnull:
+                status = subprocess.call([sys.executable, SERVER, '-p', PRODUCTS_FILE,
+                                          '-s', self.path('socket'), '--time-limit', limit],
+                                         stdout=devnull, stderr=devnull)
+            self.assertEqual(status, 2)
+            self.assertFalse(os.path.exists(self.path('socket')))
+
+    def test_compare(self):
+        self.expected_results()
+        self.run_match(['-p', self.write_previous_products(), '-r', self.path('previous.txt')])
+        # The same results in a different order, with some products left out
+        with open(self.path('shuffled.txt'), 'wb') as shuffled:
+            shuffled.writelines(sorted(self.read('previous.txt').splitlines(True))[::2])
+        for previous in ('previous.txt', 'shuffled.txt'):
+            outputs = []
+            for jobs in ('1', '3'):
+                errors = self.run_command([COMPARE, '-j', jobs, '-o', self.path('diff-' + jobs),
+                                           self.path(previous), self.path('expected.txt')])
+                outputs.append((self.read('diff-' + jobs), errors))
+            self.assertTrue(outputs[0][0])
+            self.assertEqual(outputs[1], outputs[0])
+
+        self.run_command([COMPARE, '-o', self.path('diff'),
+                          self.path('expected.txt'), self.path('expected.txt')])
+        self.assertEqual(self.read('diff'), '')
+
+    def test_shard(self):
+        expected = self.expected_results_and_unmatched()
+        self.run_shard(self.listings)
+        self.assertResultsAndUnmatched(expected)
+
+    def test_shard_products_changed(self):
+        self.run_command([SHARD, '-d', self.path('shards'), 'split', '-n', '3',
+                          '-p', PRODUCTS_FILE])
+        status, output = self.run_shard_error(['route', '-p', self.write_previous_products(),
+                                               '-l', self.listings])
+        self.assertEqual(status, 1)
+        self.assertIn('split from a different products file', output)
+
+    def test_shard_output_is_input(self):
+        status, output = self.run_shard_error(['run', '-n', '3', '-p', PRODUCTS_FILE,
+                                               '-l', self.listings, '-r', self.listings])
+        self.assertEqual(status, 2)
+        with open(SAMPLE_LISTINGS_FILE, 'rb') as sample:
+            self.assertEqual(self.read('listings.txt'),
+                             ''.join(sample.readline() for n in range(LISTINGS_COUNT)))
+
+    def test_shard_gzipped_listings(self):
+        expected = self.expected_results_and_unmatched()
+        self.run_shard(self.write_gzipped_listings())
+        self.assertResultsAndUnmatched(expected)
+
+    def test_shard_listings_from_pipe(self):
+        expected = self.expected_results_and_unmatched()
+        cat = subprocess.Popen(['cat', self.listings], stdout=subprocess.PIPE)
+        self.run_shard('-', stdin=cat.stdout)
+        cat.wait()
+        self.assertResultsAndUnmatched(expected)
+
+
+class DeadlineTest(unittest.TestCase):
+    def test_first_product_always_tried(self):
+        deadline = Deadline(-1)
+        self.assertFalse(deadline.passed())
+        self.assertFalse(deadline.skipped)
+        self.assertTrue(deadline.passed())
+        self.assertTrue(deadline.skipped)
+
+    def test_not_skipped_in_time(self):
+        deadline = Deadline(60)
+        for i in range(3):
+            self.assertFalse(deadline.passed())
+        self.assertFalse(deadline.skipped)
+
+
+def reference_searchable_title(title):
+    '''The original, step by step, way of making a searchable title, which
+    `searchable_title` does in a single pass.'''
+    title = re.sub(r'\(.*?\)', lambda m: ' ' * len(m.group()), title, flags=re.U)
+    for word in [u'for', u'pour', u'f\xfcr']:
+        m = re.search(r'\b' + word + r'\b', title, flags=re.U)
+        if m:
+            title = title[:m.start()]
+    return title[:50]
+
+
+class SearchableTitleTest(unittest.TestCase):
+    TITLES = [
+        u'',
+        u'canon powershot sx130is 12.1 mp digital camera with 12x wide angle zoom',
+        u'nikon (refurbished) coolpix s8000 14.2 mp',
+        u'case (black) for canon powershot sd1300 is',
+        u'battery (for nikon coolpix) s3000',
+        u'sony dsc-w310 (black, 12 mp, with a long note that runs past fifty) x',
+        u'olympus (unclosed parenthesis stylus 9000',
+        u'fuji fort finepix z70 forward',
+        u'housse pour appareil photo canon',
+        u'tasche f\xfcr canon ixus',
+        u'panasonic lumix dmc-fz35 with a long description running on for ever',
+        u'(a) (b) (c) kodak easyshare m530 ((nested)) pour for',
+    ]
+
+    def test_same_as_reference(self):
+        for title in self.TITLES:
+            self.assertEqual(searchable_title(title), reference_searchable_title(title), title)
+
+    def test_sample_titles(self):
+        with open(SAMPLE_LISTINGS_FILE, 'rb') as listings_file:
+            titles = [json.loads(lj)['title'].lower() for lj in listings_file]
+        self.assertEqual(searchable_titles(titles), map(reference_searchable_title, titles))
+
+
+class TitleBlobTest(unittest.TestCase):
+    TITLES = [
+        u'canon eos 5d',
+        u'5d mark ii',
+        u'',
+        u'nikon d90 kit',
+        u'd90',
+        u'x d9',
+        u'0 body',
+    ]
+    PATTERNS = [
+        # Matches well inside a title
+        r'5d',
+        # Matches at, or looking ahead to, the end of a title
+        r'd\d+',
+        r'd\d+(?=\s|$)',
+        r'(?m)d9$',
+        r'\w+\s\w+',
+        # Matches reaching from one title into the next, or through several,
+        # which must be searched for again in each title alone
+        r'kit\s*d90',
+        r'ii[\s\S]*body',
+        r'[\s\S]{20}',
+        r'\n|body',
+    ]
+
+    def assertSameAsSearchingEachTitle(self, blob, regex):
+        expected = {}
+        for i, title in enumerate(blob.titles):
+            m = regex.search(title)
+            if m:
+                expected[i] = m.span()
+        self.assertEqual(blob.first_spans(regex), expected, regex.pattern)
+
+    def test_same_as_searching_each_title(self):
+        blob = TitleBlob(self.TITLES)
+        for pattern in self.PATTERNS:
+            self.assertSameAsSearchingEachTitle(blob, re.compile(pattern, re.UNICODE))
+
+    def test_product_regexes(self):
+        with open(PRODUCTS_FILE, 'rb') as products_file:
+            products, manufacturers = read_products_data(read_lines(products_file))
+        prepare_manufacturers(manufacturers)
+        with open(SAMPLE_LISTINGS_FILE, 'rb') as listings_file:
+            blob = TitleBlob([Listing(lj).searchable_title for (n, lj) in
+                              zip(range(LISTINGS_COUNT), listings_file)])
+        for name in ('canon', 'sony'):
+            for P in manufacturers[name].products:
+                for matcher in [P._matcher] + P._token_matchers:
+                    self.assertSameAsSearchingEachTitle(blob, matcher.re)
+
+
+class PrefilterTest(unittest.TestCase):
+    def test_same_best_match_as_trying_every_product(self):
+        with open(PRODUCTS_FILE, 'rb') as products_file:
+            products, manufacturers = read_products_data(read_lines(products_file))
+        index = prepare_manufacturers(manufacturers)
+        with open(SAMPLE_LISTINGS_FILE, 'rb') as listings_file:
+            for n, lj in enumerate(listings_file):
+                if n == LISTINGS_COUNT:
+                    break
+                L = Listing(lj)
+                manufacturers_to_search = find_manufacturers_for_listing(L, manufacturers, index)
+                expected = find_best_match(L, manufacturers_to_search)
+                match = find_best_match(L, manufacturers_to_search, index)
+                self.assertEqual(match and (match.product, match.begin, match.length),
+                                 expected and (expected.product, expected.begin, expected.length))
+
+
+class TimeLimitTest(unittest.TestCase):
+    def test_capped_outcome_not_remembered(self):
+        with open(PRODUCTS_FILE, 'rb') as products_file:
+            products, manufacturers = read_products_data(read_lines(products_file))
+        index = prepare_manufacturers(manufacturers)
+        with open(SAMPLE_LISTINGS_FILE, 'rb') as listings_file:
+            # (a Canon PowerShot SX130 IS, which has several candidates)
+            listings_file.readline()
+            listing = Listing(listings_file.readline())
+        key = (listing.manufacturer, listing.searchable_title)
+
+        index.time_limit = -1
+        match_listing(listing, manufacturers, index)
+        self.assertEqual(index.capped_listings, [key])
+        self.assertIsNone(index.match_cache.get(key))
+
+        index.time_limit = None
+        outcome = match_listing(listing, manufacturers, index)
+        self.assertEqual(outcome[0].product_name, 'Canon_PowerShot_SX130_IS')
+        self.assertEqual(index.match_cache.get(key), outcome)
+
+
+if __name__ == '__main__':
+    unittest.main()